@@ -8,18 +8,60 @@ and build executor. It:
 - Creates a Kubernetes cloud profile and associates it with the project.
 - Sets up a build executor for Kubernetes within the project.
 
+Projects are given either one at a time on the command line or all at once through a
+manifest file (--manifest, JSON or YAML list of `.Values.teamcity.projects` entries).
+In both cases the project list and each project's features are fetched once, the
+create/update/skip actions are planned in memory and only the changes are applied.
+
+Before anything is written to TeamCity a pre-flight stage checks, with the same API
+server URL, service account token and CA the connectors will get, that every profile
+namespace and PodTemplate exists and that the service account holds the permissions
+agent pods need. Each distinct check runs once, concurrently, and every problem is
+reported in one pass (--skip-preflight disables it, --preflight-only stops after it).
+
 The script reads API tokens either from a provided file path or from environment variables. 
 It uses Kubernetes service account credentials (token and CA cert) for setting up the Kubernetes cloud profile.
 Avoids duplicate creation of connectors or executors if they already exist.
+
+With --watch the script runs as a controller instead of exiting: it polls the
+manifest (a mounted ConfigMap) and the credential files (the rotating projected
+service account token) and reconciles only the projects whose definition changed,
+or every connector when the credentials changed, in debounced batches.
+
+With --shard-count N (e.g. from an Indexed Job, which sets JOB_COMPLETION_INDEX)
+each process only reconciles the projects whose name hashes to its --shard-index.
+
+With --tune-builds-limit the script samples the build queue and the running builds
+of each project for a while, compares them with the namespace ResourceQuota and the
+node capacity available to the pod template, and recommends a buildsLimit per
+executor within --min-builds-limit/--max-builds-limit (applied in place with
+--tune-apply). A tuned limit is kept by later registrations until the buildsLimit
+in the manifest changes.
+
+With --prune the script reports the Kubernetes connectors and executors, smoke test
+VCS roots and build configurations that the manifest no longer declares, and the
+smoke test builds beyond the retention policy; --prune-apply deletes them.
 """
 
 import os
 import json
 import base64
-import urllib.request
-import urllib.error
-import ssl
+import hashlib
+import sys
+import time
+import signal
 import argparse
+import functools
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import idcache
+import runner
+import tuning
+import kubeapi
+import restclient
+import telemetry
 
 TEAMCITY_HEADERS = {
     "Accept": "application/json",
@@ -33,59 +75,139 @@ def read_k8s_token_and_cacert(token_path, cacert_path):
         cacert = base64.b64encode(f.read()).decode('utf-8')
     return token, cacert
 
-def make_request(url, method="GET", data=None, headers=None):
-    req = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
-    try:
-        with urllib.request.urlopen(req) as response:
-            return response.read(), response.status
-    except urllib.error.HTTPError as e:
-        return e.read(), e.code
+# Only what is compared or written back, so feature listings stay small
+FEATURE_FIELDS = "projectFeature(id,type,properties(property(name,value)))"
+PROJECT_FIELDS = f"id,name,projectFeatures({FEATURE_FIELDS})"
+# Non-secret connector property holding the digest of the credentials last written
+CREDENTIALS_FINGERPRINT = "credentialsFingerprint"
+# Connector property naming the release (--owner) that created it, so --prune leaves others alone
+MANAGED_BY = "managedBy"
+# Executor property holding the manifest buildsLimit a tuned buildsLimit replaced
+TUNED_BUILDS_LIMIT = "tunedFromBuildsLimit"
 
-def get_project_id(teamcity_url, project_name, headers):
+SESSION = restclient.Session()
+CACHE = idcache.IdCache()
+TELEMETRY = telemetry.Recorder()
+SESSION.recorder = TELEMETRY
+
+def make_request(url, method="GET", data=None, headers=None, consistent=False):
+    response = SESSION.request(url, method=method, data=data, headers=headers, consistent=consistent)
+    return response.body, response.status
+
+def read_for_write(url, headers=None):
+    """
+    GET from the main node, for reads whose result is written back or decides a write.
+    """
+    return make_request(url, headers=headers, consistent=True)
+
+def list_project_ids(teamcity_url, headers):
+    """
+    Return a {name: id} map of all TeamCity projects, paged and projected to ids and names.
+    """
     url = f"{teamcity_url}/app/rest/projects"
-    resp, status = make_request(url, headers=headers)
-    if status != 200:
-        raise RuntimeError(f"Failed to retrieve projects, status {status}")
+    projects = restclient.find_items(read_for_write, url, "project", "id,name", headers)
+    return {project["name"]: project["id"] for project in projects}
 
-    projects = json.loads(resp.decode())
-    for project in projects.get("project", []):
-        if project["name"] == project_name:
-            return project["id"]
-    return None
+def get_project_id(teamcity_url, project_name, headers):
+    url = f"{teamcity_url}/app/rest/projects"
+    projects = restclient.find_items(
+        read_for_write, url, "project", "id,name", headers,
+        locator=f"name:{restclient.locator_value(project_name)}",
+        match=lambda p: p["name"] == project_name)
+    return next((p["id"] for p in projects if p["name"] == project_name), None)
 
-def project_exists(teamcity_url, project_name, headers):
-    project_id = get_project_id(teamcity_url, project_name, headers)
-    return project_id is not None
+def get_project_with_features(teamcity_url, project_id, headers):
+    """
+    One id-addressed GET returning the project's id, name and features, or None if it is gone.
+    """
+    url = restclient.collection_url(f"{teamcity_url}/app/rest/projects/id:{project_id}", fields=PROJECT_FIELDS)
+    resp, status = read_for_write(url, headers=headers)
+    if status == 404:
+        return None
+    if status != 200:
+        raise RuntimeError(f"Failed to retrieve project {project_id}, status {status}")
+    return json.loads(resp.decode())
 
-def create_project(teamcity_url, project_name, headers):
+def create_project(teamcity_url, project_name, headers, log=print):
     url = f"{teamcity_url}/app/rest/projects"
     payload = {
         "parentProject": {"locator": "id:_Root"},
         "name": project_name
     }
     data = json.dumps(payload).encode()
-    _, status = make_request(url, method="POST", data=data, headers=headers)
+    resp, status = make_request(url, method="POST", data=data, headers=headers)
     if status not in (200, 201):
         raise RuntimeError(f"Failed to create project {project_name}, status {status}")
-    print(f"Created project {project_name}")
-
-def get_project_features(teamcity_url, project_id, headers):
-    url = f"{teamcity_url}/app/rest/projects/id:{project_id}/projectFeatures"
-    resp, status = make_request(url, headers=headers)
-    if status != 200:
-        raise RuntimeError(f"Failed to retrieve features for project {project_id}, status {status}")
-    return json.loads(resp.decode())
+    log(f"Created project {project_name}")
+    return json.loads(resp.decode())["id"]
 
-def feature_exists(features, key_name, value, feature_type):
+def find_feature(features, key_name, value, feature_type):
     for feature in features.get("projectFeature", []):
         if feature.get("type") != feature_type:
             continue
         for prop in feature.get("properties", {}).get("property", []):
             if prop.get("name") == key_name and prop.get("value") == value:
-                return True
-    return False
+                return feature
+    return None
+
+def credentials_fingerprint(token, cacert):
+    """
+    Digest of the service account token and CA cert. It is stored on the connector as a
+    non-secret property so unchanged credentials don't need a PUT (and a settings reload).
+    """
+    return hashlib.sha256(f"{token}\n{cacert}".encode()).hexdigest()
+
+def connector_properties(profile):
+    properties = [
+        {"name": "apiServerUrl", "value": profile["apiServerUrl"]},
+        {"name": "namespace", "value": profile["namespace"]},
+        {"name": "displayName", "value": profile["name"]},
+        {"name": "authStrategy", "value": "token"},
+        {"name": "providerType", "value": "KubernetesConnection"}
+    ]
+    if profile.get("owner"):
+        properties.append({"name": MANAGED_BY, "value": profile["owner"]})
+    return properties
+
+def executor_properties(teamcity_url, profile, connector_id):
+    return [
+        {"name": "buildsLimit", "value": profile["buildsLimit"]},
+        {"name": "connectionId", "value": connector_id},
+        {"name": "executorType", "value": "KubernetesExecutor"},
+        {"name": "profileDescription", "value": "k8s agent"},
+        {"name": "profileName", "value": "k8s agent"},
+        {"name": "profileServerUrl", "value": teamcity_url},
+        {"name": "containerParameters", "value": profile["containerParameters"]},
+        {"name": "templateName", "value": profile["templateName"]}
+    ]
+
+def property_drift(feature, desired):
+    """
+    Return the names of the desired properties whose value differs on the feature.
+    """
+    current = {p["name"]: p.get("value") for p in feature.get("properties", {}).get("property", [])}
+    return [p["name"] for p in desired if current.get(p["name"]) != p["value"]]
+
+def upsert_properties(feature, desired):
+    props = feature.setdefault("properties", {}).setdefault("property", [])
+    by_name = {p["name"]: p for p in props}
+    for prop in desired:
+        if prop["name"] in by_name:
+            by_name[prop["name"]]["value"] = prop["value"]
+        else:
+            props.append(dict(prop))
+
+def feature_property(feature, name):
+    return next((p.get("value") for p in feature.get("properties", {}).get("property", []) if p["name"] == name), None)
+
+def put_feature(teamcity_url, project_id, feature, headers):
+    url = f"{teamcity_url}/app/rest/projects/id:{project_id}/projectFeatures/id:{feature['id']}"
+    data = json.dumps(feature).encode()
+    resp, status = make_request(url, method="PUT", data=data, headers=headers)
+    if status not in (200, 201):
+        raise RuntimeError(f"Failed to update feature {feature['id']}, status {status}, response: {resp.decode(errors='replace')}")
 
-def create_k8s_connector(teamcity_url, project_id, profile, token, cacert, headers):
+def create_k8s_connector(teamcity_url, project_id, profile, token, cacert, headers, log=print):
     """
     Create a Kubernetes connection (OAuthProvider) in TeamCity for the project.
     """
@@ -96,12 +218,8 @@ def create_k8s_connector(teamcity_url, project_id, profile, token, cacert, heade
         "cloudCode": "kubernetes",
         "type": "OAuthProvider",
         "properties": {
-            "property": [
-                {"name": "apiServerUrl", "value": profile["apiServerUrl"]},
-                {"name": "namespace", "value": profile["namespace"]},
-                {"name": "displayName", "value": profile["name"]},
-                {"name": "authStrategy", "value": "token"},
-                {"name": "providerType", "value": "KubernetesConnection"},
+            "property": connector_properties(profile) + [
+                {"name": CREDENTIALS_FINGERPRINT, "value": credentials_fingerprint(token, cacert)},
                 {"name": "secure:caCertData", "value": cacert},
                 {"name": "secure:authToken", "value": token}
             ]
@@ -112,42 +230,44 @@ def create_k8s_connector(teamcity_url, project_id, profile, token, cacert, heade
     if status not in (200, 201):
         raise RuntimeError(f"Failed to create Kubernetes connector, status {status}")
     result = json.loads(resp.decode())
-    print(f"Created Kubernetes connector: {profile['name']}")
+    log(f"Created Kubernetes connector: {profile['name']}")
     return result["id"]
 
-def update_k8s_connector(teamcity_url, project_id, connector_id, cacert, token, headers):
-    # Get existing feature
+def update_k8s_connector(teamcity_url, project_id, connector_id, cacert, token, headers,
+                         feature=None, profile=None, force_rotate=False, log=print):
+    """
+    Update the connector's credentials (and, given a profile, its other properties).
+    The PUT is skipped when the stored credentials fingerprint matches and nothing else
+    drifted, unless force_rotate is set. Returns True if the connector was updated.
+    """
     url = f"{teamcity_url}/app/rest/projects/id:{project_id}/projectFeatures/id:{connector_id}"
-    resp, status = make_request(url, headers=headers)
-    if status != 200:
-        raise RuntimeError(f"Failed to fetch Kubernetes connector for update, status {status}")
-
-    feature = json.loads(resp.decode())
+    # Get existing feature, unless it was already fetched with the project's features
+    if feature is None:
+        resp, status = read_for_write(url, headers=headers)
+        if status != 200:
+            raise RuntimeError(f"Failed to fetch Kubernetes connector for update, status {status}")
+        feature = json.loads(resp.decode())
 
-    # Update secure properties
-    props = feature.get("properties", {}).get("property", [])
-    # Helper to update or add property
-    def upsert_property(name, value):
-        for p in props:
-            if p["name"] == name:
-                p["value"] = value
-                return
-        props.append({"name": name, "value": value})
+    fingerprint = {"name": CREDENTIALS_FINGERPRINT, "value": credentials_fingerprint(token, cacert)}
+    drift = property_drift(feature, connector_properties(profile)) if profile else []
+    rotate = force_rotate or property_drift(feature, [fingerprint])
+    if not rotate and not drift:
+        log(f"Kubernetes connector {connector_id} is up to date, credentials fingerprint unchanged.")
+        return False
 
-    upsert_property("secure:caCertData", cacert)
-    upsert_property("secure:authToken", token)
+    desired = (connector_properties(profile) if profile else []) + [
+        fingerprint,
+        {"name": "secure:caCertData", "value": cacert},
+        {"name": "secure:authToken", "value": token}
+    ]
+    upsert_properties(feature, desired)
+    put_feature(teamcity_url, project_id, feature, headers)
+    changed = (["caCertData", "authToken"] if rotate else []) + drift
+    log(f"Updated Kubernetes connector {connector_id}: {', '.join(changed)}")
+    return True
 
-    feature["properties"]["property"] = props
 
-    # PUT updated feature back
-    data = json.dumps(feature).encode()
-    resp, status = make_request(url, method="PUT", data=data, headers=headers)
-    if status not in (200, 201):
-        raise RuntimeError(f"Failed to update Kubernetes connector, status {status}, response: {resp.decode(errors='replace')}")
-    print(f"Updated Kubernetes connector {connector_id} with new caCertData and authToken")
-
-
-def create_k8s_cloud_profile(teamcity_url, project_id, profile, connector_id, headers):
+def create_k8s_cloud_profile(teamcity_url, project_id, profile, connector_id, headers, log=print):
     """
     Create a Kubernetes cloud profile (BuildExecutor) that uses the connector.
     """
@@ -155,87 +275,871 @@ def create_k8s_cloud_profile(teamcity_url, project_id, profile, connector_id, he
     payload = {
         "type": "BuildExecutor",
         "properties": {
-            "property": [
-                {"name": "buildsLimit", "value": profile["buildsLimit"]},
-                {"name": "connectionId", "value": connector_id},
-                {"name": "executorType", "value": "KubernetesExecutor"},
-                {"name": "profileDescription", "value": "k8s agent"},
-                {"name": "profileName", "value": "k8s agent"},
-                {"name": "profileServerUrl", "value": teamcity_url},
-                {"name": "containerParameters", "value": profile["containerParameters"]},
-                {"name": "templateName", "value": profile["templateName"]}
-            ]
+            "property": executor_properties(teamcity_url, profile, connector_id)
         }
     }
     data = json.dumps(payload).encode()
     resp, status = make_request(url, method="POST", data=data, headers=headers)
     if status not in (200, 201):
         raise RuntimeError(f"Failed to add Kubernetes cloud profile, status {status}")
-    print("Created Kubernetes cloud profile")
+    log("Created Kubernetes cloud profile")
+    return json.loads(resp.decode())["id"]
+
+def update_k8s_cloud_profile(teamcity_url, project_id, feature, profile, connector_id, headers, log=print):
+    """
+    Update the BuildExecutor in place when its settings drifted from the profile
+    (buildsLimit, containerParameters, templateName, connector...). Returns True if updated.
+    """
+    desired = executor_properties(teamcity_url, profile, connector_id)
+    tuned_from = feature_property(feature, TUNED_BUILDS_LIMIT)
+    if tuned_from == profile["buildsLimit"]:
+        # Tuned since the manifest last changed the limit
+        desired = [p for p in desired if p["name"] != "buildsLimit"]
+    elif tuned_from:
+        desired.append({"name": TUNED_BUILDS_LIMIT, "value": ""})
+    drift = property_drift(feature, desired)
+    if not drift:
+        log("BuildExecutor feature 'k8s agent' is up to date.")
+        return False
+    upsert_properties(feature, desired)
+    put_feature(teamcity_url, project_id, feature, headers)
+    log(f"Updated BuildExecutor feature 'k8s agent': {', '.join(drift)}")
+    return True
+
+
+def join_container_parameters(parameters):
+    # Same "key=value,key=value" format (sorted by key) as the chart's joinMap helper
+    if isinstance(parameters, dict):
+        return ",".join(f"{k}={v}" for k, v in sorted(parameters.items()))
+    return parameters or ""
+
+def profile_from_spec(spec, owner=None):
+    profile = spec["k8sProfile"]
+    return {
+        "name": profile["name"],
+        "apiServerUrl": profile["apiServerUrl"],
+        "namespace": profile["namespace"],
+        "buildsLimit": str(profile["buildsLimit"]),
+        "containerParameters": join_container_parameters(profile.get("containerParameters")),
+        "templateName": profile["templateName"],
+        "owner": owner
+    }
+
+def plan_project(spec, project_id, features, owner=None):
+    """
+    Work out, without touching the server, what has to change for one project.
+    """
+    profile = profile_from_spec(spec, owner)
+    return {
+        "name": spec["name"],
+        "project_id": project_id,
+        "profile": profile,
+        "create_project": project_id is None,
+        "connector": find_feature(features, "displayName", profile["name"], "OAuthProvider"),
+        "executor": find_feature(features, "profileName", "k8s agent", "BuildExecutor"),
+    }
+
+def apply_plan(teamcity_url, plan, token, cacert, headers, force_rotate=False, log=print):
+    """
+    Apply a plan and return the ids of the project, connector and executor.
+    """
+    profile = plan["profile"]
+
+    project_id = plan["project_id"]
+    if plan["create_project"]:
+        with TELEMETRY.span("project create", project=plan["name"]):
+            project_id = create_project(teamcity_url, plan["name"], headers, log=log)
+    else:
+        log(f"Project {plan['name']} already exists.")
+
+    connector = plan["connector"]
+    with TELEMETRY.span("connector upsert", project=plan["name"]):
+        if connector is None:
+            oauth_id = create_k8s_connector(teamcity_url, project_id, profile, token, cacert, headers, log=log)
+        else:
+            log(f"Kubernetes cloud profile {profile['name']} already exists.")
+            oauth_id = connector["id"]
+            update_k8s_connector(teamcity_url, project_id, oauth_id, cacert, token, headers,
+                                 feature=connector, profile=profile, force_rotate=force_rotate, log=log)
 
+    executor = plan["executor"]
+    with TELEMETRY.span("executor upsert", project=plan["name"]):
+        if executor is None:
+            executor_id = create_k8s_cloud_profile(teamcity_url, project_id, profile, oauth_id, headers, log=log)
+        else:
+            executor_id = executor["id"]
+            update_k8s_cloud_profile(teamcity_url, project_id, executor, profile, oauth_id, headers, log=log)
+
+    return {"project_id": project_id, "connector_id": oauth_id, "executor_id": executor_id}
+
+def resolve_project(teamcity_url, name, project_ids, headers):
+    """
+    Return the project (with its features) named `name`, or None if it does not exist.
+    A cached id is revalidated with one id-addressed GET; otherwise the id comes from
+    the project listing when it was fetched, or from a name locator lookup.
+    """
+    key = f"project:{name}"
+    cached = CACHE.get(key)
+    if cached:
+        project = get_project_with_features(teamcity_url, cached["id"], headers)
+        if project is not None and project["name"] == name:
+            CACHE.record_lookup(hit=True)
+            return project
+        CACHE.invalidate(key)
+    CACHE.record_lookup(hit=False)
+
+    if project_ids is not None and not cached:
+        project_id = project_ids.get(name)
+    else:
+        project_id = get_project_id(teamcity_url, name, headers)
+    return get_project_with_features(teamcity_url, project_id, headers) if project_id else None
+
+def reconcile_project(teamcity_url, spec, project_ids, token, cacert, headers, force_rotate=False, owner=None,
+                      log=print):
+    """
+    Fetch one project and its features once, plan its actions and apply only the changes.
+    """
+    with TELEMETRY.span("project lookup", project=spec["name"]):
+        project = resolve_project(teamcity_url, spec["name"], project_ids, headers)
+    project_id = project["id"] if project else None
+    features = project.get("projectFeatures", {}) if project else {}
+    plan = plan_project(spec, project_id, features, owner)
+    ids = apply_plan(teamcity_url, plan, token, cacert, headers, force_rotate=force_rotate, log=log)
+    # Features come with the project GET, so only the project id is worth caching
+    CACHE.set(f"project:{spec['name']}", ids["project_id"])
+
+def reconcile_projects(teamcity_url, specs, token, cacert, headers, concurrency=1, force_rotate=False, owner=None):
+    """
+    Reconcile all projects on a bounded worker pool. Output is printed per project in
+    manifest order as soon as it is complete. Returns a list of (name, error) failures.
+    The project listing is only fetched when some project is not in the id cache.
+    """
+    project_ids = None
+    if any(CACHE.get(f"project:{spec['name']}") is None for spec in specs):
+        with TELEMETRY.span("project listing"):
+            project_ids = list_project_ids(teamcity_url, headers)
+    tasks = [
+        (spec["name"], functools.partial(
+            reconcile_project, teamcity_url, spec, project_ids, token, cacert, headers, force_rotate, owner))
+        for spec in specs
+    ]
+    results = runner.run_in_order(tasks, concurrency)
+    failures = [(name, str(error)) for name, _, error in results if error]
+    CACHE.save()
+    return failures
+
+def shard_of(name, shard_count):
+    """
+    Stable shard of a project: the same name always lands on the same shard, whatever
+    the order or the other entries of the manifest.
+    """
+    return int(hashlib.sha256(name.encode()).hexdigest()[:16], 16) % shard_count
+
+def select_shard(specs, shard_index, shard_count):
+    if shard_count <= 1:
+        return specs
+    return [spec for spec in specs if shard_of(spec["name"], shard_count) == shard_index]
+
+def shard_path(path, shard_index, shard_count):
+    """
+    Per-shard variant of a file path (e.g. the id cache), so that shards sharing a
+    volume never overwrite each other's file.
+    """
+    if not path or shard_count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-shard{shard_index}{ext}"
+
+def print_summary(specs, failures, prefix="Summary"):
+    print(f"{prefix}: {len(specs) - len(failures)} of {len(specs)} projects reconciled, {len(failures)} failed.")
+    for name, error in failures:
+        print(f"  FAILED {name}: {error}")
+
+
+def spec_digest(spec):
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def files_digest(*paths):
+    """
+    Digest of the content of the given files; missing files count as empty.
+    """
+    digest = hashlib.sha256()
+    for path in filter(None, paths):
+        try:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        except FileNotFoundError:
+            pass
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def read_api_token(api_token_path):
+    if api_token_path:
+        with open(api_token_path, 'r') as f:
+            return f.read().strip()
+    api_token = os.getenv('API_TOKEN')
+    if not api_token:
+        raise RuntimeError("API token is not provided or found in environment variables.")
+    return api_token
+
+def teamcity_headers(api_token):
+    headers = TEAMCITY_HEADERS.copy()
+    headers["Authorization"] = f"Bearer {api_token}"
+    return headers
+
+def watch(args, stop, log=print):
+    """
+    Controller loop: every `args.watch_interval` seconds hash the manifest entries and
+    the credential files, and once nothing changed for `args.debounce` seconds
+    reconcile every project whose hash differs from the one last applied in a single
+    batch. Failed projects are retried with a growing delay, and all projects are
+    reconciled again every `args.resync_period` seconds to repair drift made in TeamCity.
+    """
+    # Project name -> (spec digest, credentials digest) last reconciled successfully
+    applied = {}
+    first = True
+    observed = None
+    changed_at = time.monotonic()
+    next_resync = 0.0
+    # Project name -> monotonic time before which a failed project is not retried
+    retry_at = {}
+    failure_delay = args.debounce
+    while not stop.is_set():
+        now = time.monotonic()
+        try:
+            specs = runner.load_manifest(args.manifest)
+            # The API token is re-read for every batch but only the connector credentials dirty projects
+            credentials = files_digest(args.token_path, args.cacert_path)
+        except Exception as e:
+            log(f"Cannot read the manifest or credentials, keeping the last state: {e}")
+            stop.wait(args.watch_interval)
+            continue
+
+        digests = {spec["name"]: spec_digest(spec) for spec in specs}
+        if (digests, credentials) != observed:
+            observed = (digests, credentials)
+            changed_at = now
+        for name in set(applied) - set(digests):
+            log(f"Project {name} is no longer in the manifest; it is left as is in TeamCity.")
+            del applied[name]
+
+        resync = args.resync_period and now >= next_resync
+        dirty = [spec for spec in specs if resync or (
+            applied.get(spec["name"]) != (digests[spec["name"]], credentials) and retry_at.get(spec["name"], 0) <= now)]
+        settled = first or now - changed_at >= args.debounce
+        if dirty and settled:
+            reason = "startup" if first else "resync" if resync else "changed"
+            first = False
+            log(f"Reconciling {len(dirty)} of {len(specs)} projects ({reason}).")
+            try:
+                token, cacert = read_k8s_token_and_cacert(args.token_path, args.cacert_path)
+                headers = teamcity_headers(read_api_token(args.api_token_path))
+                problems = {} if args.skip_preflight else preflight(dirty, args, log=log)[0]
+                failures = [(name, "; ".join(messages)) for name, messages in problems.items()]
+                failures += reconcile_projects(args.teamcity_url, [spec for spec in dirty if spec["name"] not in problems],
+                                               token, cacert, headers, args.concurrency, args.force_rotate, args.owner)
+            except Exception as e:
+                failures = [(spec["name"], str(e)) for spec in dirty]
+            print_summary(dirty, failures)
+            print(SESSION.summary())
+            telemetry.export(TELEMETRY, SESSION, args, "add-project")
+            TELEMETRY.reset()
+
+            failed = {name for name, _ in failures}
+            for spec in dirty:
+                if spec["name"] in failed:
+                    retry_at[spec["name"]] = now + failure_delay
+                else:
+                    applied[spec["name"]] = (digests[spec["name"]], credentials)
+                    retry_at.pop(spec["name"], None)
+            if failed:
+                log(f"Retrying {len(failed)} failed projects in {failure_delay:.0f}s.")
+                failure_delay = min(failure_delay * 2, args.max_failure_delay)
+            else:
+                failure_delay = args.debounce
+            if resync:
+                next_resync = now + args.resync_period
+        stop.wait(args.watch_interval)
+
+# What TeamCity does with the connector's service account in each profile namespace
+REQUIRED_PERMISSIONS = (("pods", "get"), ("pods", "list"), ("pods", "create"), ("pods", "delete"),
+                        ("podtemplates", "get"), ("podtemplates", "list"))
+
+def preflight_checks(specs):
+    """
+    The distinct checks the specs need, each mapped to the names of the projects that
+    depend on it: ("namespace", server, namespace), ("podtemplate", server, namespace,
+    name) and ("permission", server, namespace, resource, verb).
+    """
+    checks = {}
+    for spec in specs:
+        profile = spec["k8sProfile"]
+        server, namespace = profile["apiServerUrl"].rstrip("/"), profile["namespace"]
+        keys = [("namespace", server, namespace), ("podtemplate", server, namespace, profile["templateName"])]
+        keys += [("permission", server, namespace, resource, verb) for resource, verb in REQUIRED_PERMISSIONS]
+        for key in keys:
+            checks.setdefault(key, []).append(spec["name"])
+    return checks
+
+def self_access_review(kube, namespace, resource, verb):
+    """
+    Ask the API server whether the service account may `verb` `resource` in `namespace`.
+    """
+    attributes = {"resource": resource, "verb": verb}
+    if namespace:
+        attributes["namespace"] = namespace
+    return kube.request("/apis/authorization.k8s.io/v1/selfsubjectaccessreviews", method="POST", body={
+        "apiVersion": "authorization.k8s.io/v1",
+        "kind": "SelfSubjectAccessReview",
+        "spec": {"resourceAttributes": attributes},
+    })
+
+def run_preflight_check(kube, check):
+    """
+    Run one check; returns None, ("problem", message) or ("warning", message).
+    """
+    kind, server, namespace = check[:3]
+    try:
+        if kind == "server":
+            # /version is public; any authenticated token may create a self access review
+            self_access_review(kube, None, "pods", "list")
+        elif kind == "namespace":
+            kube.get(f"/api/v1/namespaces/{namespace}")
+        elif kind == "podtemplate":
+            kube.get(f"/api/v1/namespaces/{namespace}/podtemplates/{check[3]}")
+        else:
+            review = self_access_review(kube, namespace, check[3], check[4])
+            if not review.get("status", {}).get("allowed"):
+                reason = review.get("status", {}).get("reason")
+                return "problem", f"service account may not {check[4]} {check[3]} in namespace {namespace}" + \
+                    (f" ({reason})" if reason else "")
+    except kubeapi.KubeError as e:
+        if kind == "namespace" and e.status == 404:
+            return "problem", f"namespace {namespace} does not exist"
+        if kind == "namespace" and e.status == 403:
+            # Namespaces are cluster-scoped and the chart's Role cannot grant reading them
+            return "warning", f"cannot verify that namespace {namespace} exists: {e}"
+        if kind == "podtemplate" and e.status == 404:
+            return "problem", f"PodTemplate {check[3]} not found in namespace {namespace}"
+        if e.status == 401:
+            return "problem", f"API server {server} rejected the service account token: {e}"
+        return "problem", str(e)
+    except (*restclient.TRANSIENT_ERRORS, ValueError) as e:
+        return "problem", f"API server {server} is unreachable: {e}"
+    return None
+
+def preflight(specs, args, log=print):
+    """
+    Check the specs' Kubernetes profiles before any TeamCity write. The API servers are
+    checked first; the namespace, PodTemplate and permission checks of the reachable
+    ones then run concurrently. Returns ({project name: [problems]}, [warnings]).
+    """
+    checks = preflight_checks(specs)
+    servers = sorted({check[1] for check in checks})
+    session = restclient.Session()
+    session.configure(args.cacert_path, args.connect_timeout, args.read_timeout,
+                      retry_policy=restclient.RetryPolicy(retries=2, backoff=0.5))
+    clients = {server: kubeapi.KubeClient(server, args.token_path, args.cacert_path, session=session) for server in servers}
+
+    problems, warnings = {}, []
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        with TELEMETRY.span("preflight", stage="servers"):
+            results = list(pool.map(lambda server: run_preflight_check(clients[server], ("server", server, None)), servers))
+        unreachable = {server for server, result in zip(servers, results) if result}
+        for server, result in zip(servers, results):
+            if result:
+                users = sorted({name for check, names in checks.items() if check[1] == server for name in names})
+                for name in users:
+                    problems.setdefault(name, []).append(result[1])
+                log(f"PROBLEM {result[1]} (projects: {', '.join(users)})")
+
+        pending = [check for check in checks if check[1] not in unreachable]
+        with TELEMETRY.span("preflight", stage="checks", count=len(pending)):
+            results = list(pool.map(lambda check: run_preflight_check(clients[check[1]], check), pending))
+    for check, result in zip(pending, results):
+        if not result:
+            continue
+        severity, message = result
+        names = sorted(set(checks[check]))
+        if severity == "warning":
+            warnings.append(message)
+            log(f"WARNING {message}")
+            continue
+        for name in names:
+            problems.setdefault(name, []).append(message)
+        log(f"PROBLEM {message} (projects: {', '.join(names)})")
+
+    kinds = {kind: sum(1 for check in checks if check[0] == kind) for kind in ("namespace", "podtemplate", "permission")}
+    log(f"Pre-flight: {kinds['namespace']} namespaces, {kinds['podtemplate']} PodTemplates and "
+        f"{kinds['permission']} permissions on {len(servers)} API servers checked for {len(specs)} projects; "
+        f"{len(problems)} projects have problems, {len(warnings)} warnings.")
+    session.close()
+    return problems, warnings
+
+def sample_build_load(teamcity_url, project_ids, headers):
+    """
+    One sample of the queued builds (by wait reason, see tuning.classify_wait_reason)
+    and running builds of each of the given projects, subprojects included since the
+    project's executor serves them too. A server rejecting the affectedProject locator
+    gets the project's own builds only.
+    """
+    load = {}
+    for project_id in project_ids:
+        counts = load[project_id] = {"running": 0, "starting": 0, "limit": 0, "agents": 0, "other": 0}
+        subtree = f"affectedProject:(id:{project_id})"
+        own = lambda build: build.get("buildType", {}).get("projectId") == project_id
+        queued = restclient.find_items(make_request, f"{teamcity_url}/app/rest/buildQueue", "build",
+                                       "id,waitReason,buildType(projectId)", headers, locator=subtree, match=own)
+        for build in queued:
+            counts[tuning.classify_wait_reason(build.get("waitReason"))] += 1
+        running = restclient.find_items(make_request, f"{teamcity_url}/app/rest/builds", "build",
+                                        "id,buildType(projectId)", headers, locator=f"{subtree},state:running",
+                                        fallback_locator="state:running", match=own)
+        counts["running"] = len(running)
+    return load
+
+def kubernetes_capacity(kube, specs, log=print):
+    """
+    Per project, the agent pods its namespace's ResourceQuotas and the nodes its pod
+    template can be scheduled on would hold if it had them to itself (None if unknown).
+    """
+    def fetch(description, path):
+        try:
+            return kube.get(path) if "/podtemplates/" in path else kube.list(path)
+        except (kubeapi.KubeError, *restclient.TRANSIENT_ERRORS) as e:
+            log(f"Cannot read {description}, not capping by it: {e}")
+            return None
+
+    nodes = fetch("nodes", "/api/v1/nodes")
+    templates, quotas, capacity = {}, {}, {}
+    for spec in specs:
+        profile = spec["k8sProfile"]
+        name, namespace = profile["templateName"], profile["namespace"]
+        # The profile namespace, where pre-flight and the smoke test read the template too
+        if (namespace, name) not in templates:
+            template = fetch(f"PodTemplate {namespace}/{name}", f"/api/v1/namespaces/{namespace}/podtemplates/{name}")
+            templates[namespace, name] = (template or {}).get("template", {}).get("spec") if template else None
+        if namespace not in quotas:
+            quotas[namespace] = fetch(f"ResourceQuotas of {namespace}", f"/api/v1/namespaces/{namespace}/resourcequotas")
+        pod_spec = templates[namespace, name]
+        needed = kubeapi.pod_resources(pod_spec) if pod_spec is not None else None
+        capacity[spec["name"]] = {
+            "quota": tuning.quota_capacity(quotas[namespace], needed) if needed and quotas[namespace] is not None else None,
+            "nodes": tuning.node_capacity(nodes, pod_spec, needed) if needed and nodes is not None else None,
+        }
+    return capacity
+
+def apply_builds_limit(teamcity_url, project_id, limit, configured, headers, log=print):
+    """
+    Set the project's executor buildsLimit in place, remembering the manifest value it replaced.
+    """
+    project = get_project_with_features(teamcity_url, project_id, headers)
+    executor = find_feature((project or {}).get("projectFeatures", {}), "profileName", "k8s agent", "BuildExecutor")
+    if executor is None:
+        raise RuntimeError(f"Project {project_id} has no Kubernetes executor")
+    upsert_properties(executor, [{"name": "buildsLimit", "value": str(limit)},
+                                 {"name": TUNED_BUILDS_LIMIT, "value": configured}])
+    put_feature(teamcity_url, project_id, executor, headers)
+    log(f"Set buildsLimit to {limit}")
+
+def tune_builds_limits(args, specs, headers, stop, log=print):
+    """
+    Sample the projects' build load for `args.tune_duration` seconds, recommend a
+    buildsLimit per executor and, with `args.tune_apply`, set it. Returns failures.
+    """
+    project_ids = list_project_ids(args.teamcity_url, headers)
+    current = {}
+    for spec in specs:
+        project = get_project_with_features(args.teamcity_url, project_ids[spec["name"]], headers) \
+            if spec["name"] in project_ids else None
+        executor = find_feature((project or {}).get("projectFeatures", {}), "profileName", "k8s agent", "BuildExecutor")
+        if executor is None:
+            log(f"Project {spec['name']} has no Kubernetes executor yet, skipped.")
+            continue
+        current[spec["name"]] = int(feature_property(executor, "buildsLimit") or 0)
+    specs = [spec for spec in specs if spec["name"] in current]
+
+    samples = {spec["name"]: [] for spec in specs}
+    deadline = time.monotonic() + args.tune_duration
+    log(f"Sampling build load of {len(specs)} projects every {args.tune_interval:g}s for {args.tune_duration:g}s.")
+    while not stop.is_set():
+        with TELEMETRY.span("load sample"):
+            load = sample_build_load(args.teamcity_url, {project_ids[s["name"]] for s in specs}, headers)
+        for spec in specs:
+            samples[spec["name"]].append(load[project_ids[spec["name"]]])
+        if time.monotonic() + args.tune_interval > deadline:
+            break
+        stop.wait(args.tune_interval)
+
+    kube = kubeapi.KubeClient(args.k8s_api_url, args.token_path, args.cacert_path)
+    capacity = kubernetes_capacity(kube, specs, log=log)
+    wanted = {name: tuning.demand(s, args.tune_percentile, args.tune_headroom) for name, s in samples.items()}
+    # Projects sharing a namespace or a template's nodes split their capacity by demand
+    groups = {}
+    for spec in specs:
+        profile = spec["k8sProfile"]
+        groups.setdefault(("quota", profile["namespace"]), []).append(spec["name"])
+        groups.setdefault(("nodes", profile["templateName"]), []).append(spec["name"])
+
+    recommendations = []
+    for spec in specs:
+        name, profile = spec["name"], spec["k8sProfile"]
+        caps = {kind: tuning.share(capacity[name][kind], wanted[name], [wanted[n] for n in groups[(kind, key)]])
+                for kind, key in (("quota", profile["namespace"]), ("nodes", profile["templateName"]))}
+        limit, reason = tuning.recommend(current[name], wanted[name], caps, args.min_builds_limit, args.max_builds_limit)
+        limited = sum(1 for s in samples[name] if s["limit"])
+        recommendations.append((spec, current[name], limit, reason, limited))
+
+    print(f"buildsLimit recommendations ({len(next(iter(samples.values()), []))} samples, "
+          f"p{args.tune_percentile:g} demand + {args.tune_headroom} headroom, "
+          f"bounds {args.min_builds_limit}-{args.max_builds_limit}):")
+    for spec, was, limit, reason, limited in recommendations:
+        peak = max((s["running"] + s["starting"] for s in samples[spec["name"]]), default=0)
+        print(f"  {spec['name']}: {was} -> {limit} ({reason}; peak running {peak}, "
+              f"held back by a limit in {limited} of {len(samples[spec['name']])} samples)")
+
+    changes = [(spec, limit) for spec, was, limit, _, _ in recommendations if limit != was]
+    if not args.tune_apply or not changes:
+        return []
+    tasks = [(spec["name"], functools.partial(
+        apply_builds_limit, args.teamcity_url, project_ids[spec["name"]], limit,
+        str(spec["k8sProfile"]["buildsLimit"]), headers)) for spec, limit in changes]
+    results = runner.run_in_order(tasks, args.concurrency)
+    return [(name, str(error)) for name, _, error in results if error]
+
+def is_managed_connector(feature):
+    props = {p["name"]: p.get("value") for p in feature.get("properties", {}).get("property", [])}
+    return (feature.get("type") == "OAuthProvider" and props.get("providerType") == "KubernetesConnection"
+            and props.get("authStrategy") == "token")
+
+def is_owned_connector(feature, owner, fingerprint):
+    """
+    A connector this release created: marked with its --owner or, for connectors created
+    before the owner was recorded, holding its current credentials.
+    """
+    if not is_managed_connector(feature):
+        return False
+    marked = feature_property(feature, MANAGED_BY)
+    if marked:
+        return marked == owner
+    return feature_property(feature, CREDENTIALS_FINGERPRINT) == fingerprint
+
+def is_managed_executor(feature):
+    props = {p["name"]: p.get("value") for p in feature.get("properties", {}).get("property", [])}
+    return (feature.get("type") == "BuildExecutor" and props.get("executorType") == "KubernetesExecutor"
+            and props.get("profileDescription") == "k8s agent")
+
+def prune_item(kind, project, url, description, cache_key=None, object_id=None):
+    return {"kind": kind, "project": project, "url": url, "description": description,
+            "cache_key": cache_key, "id": object_id}
+
+def stale_features(teamcity_url, project, spec, owner, fingerprint):
+    """
+    Connectors this release created and the executors using them that `spec` (None for
+    a project no longer in the manifest) does not declare. A connector an executor that
+    stays still points at (e.g. the declared one, before the renamed profile's connector
+    is registered) is kept.
+    """
+    features = project.get("projectFeatures", {})
+    declared = []
+    if spec is not None:
+        profile = profile_from_spec(spec)
+        declared = [find_feature(features, "displayName", profile["name"], "OAuthProvider"),
+                    find_feature(features, "profileName", "k8s agent", "BuildExecutor")]
+    owned = {f["id"] for f in features.get("projectFeature", []) if is_owned_connector(f, owner, fingerprint)}
+    stale = [f for f in features.get("projectFeature", []) if not any(f is d for d in declared) and (
+        f["id"] in owned or is_managed_executor(f) and feature_property(f, "connectionId") in owned)]
+    in_use = {feature_property(f, "connectionId") for f in features.get("projectFeature", [])
+              if f["type"] == "BuildExecutor" and not any(f is s for s in stale)}
+    items = []
+    for feature in stale:
+        if feature["type"] == "OAuthProvider" and feature["id"] in in_use:
+            continue
+        url = f"{teamcity_url}/app/rest/projects/id:{project['id']}/projectFeatures/id:{feature['id']}"
+        if feature["type"] == "OAuthProvider":
+            name = feature_property(feature, "displayName")
+            items.append(prune_item("OAuthProvider", project["name"], url, f"connector {feature['id']} '{name}'"))
+        else:
+            items.append(prune_item("BuildExecutor", project["name"], url,
+                                    f"executor {feature['id']} (connection {feature_property(feature, 'connectionId')})"))
+    return items
+
+def stale_smoke_artifacts(teamcity_url, project, spec, args, headers):
+    """
+    Smoke test build configurations and VCS roots `spec` no longer declares (or
+    renamed), and the builds of the declared one beyond --keep-builds/--keep-days.
+    """
+    project_locator = f"project:(id:{project['id']})"
+    build_types = restclient.find_items(read_for_write, f"{teamcity_url}/app/rest/buildTypes", "buildType",
+                                        "id,name,vcs-root-entries(vcs-root-entry(id))", headers,
+                                        fallback_locator=project_locator)
+    vcs_roots = restclient.find_items(read_for_write, f"{teamcity_url}/app/rest/vcs-roots", "vcs-root", "id,name", headers,
+                                      fallback_locator=project_locator)
+    smoke = (spec or {}).get("smokeTest") or {}
+    root_name = smoke.get("vcsRootName") or args.smoke_vcs_root_name or f"{args.smoke_build_config_name}-Git"
+    configs = [bt for bt in build_types if bt["name"] == args.smoke_build_config_name]
+    kept = configs[:1] if smoke.get("gitUrl") else []
+
+    def entries(bt):
+        return {e["id"] for e in bt.get("vcs-root-entries", {}).get("vcs-root-entry", [])}
+
+    used = set().union(*(entries(bt) for bt in build_types if bt not in configs), set())
+    smoke_roots = set().union(*(entries(bt) for bt in configs), set())
+    names = {r["id"]: r["name"] for r in vcs_roots}
+    kept_roots = {r["id"] for r in vcs_roots if kept and r["name"] == root_name}
+
+    items = []
+    for bt in configs:
+        if bt in kept:
+            continue
+        items.append(prune_item("build configuration", project["name"], f"{teamcity_url}/app/rest/buildTypes/id:{bt['id']}",
+                                f"build configuration {bt['id']} '{bt['name']}' and its builds",
+                                f"buildType:{project['id']}:{bt['name']}", bt["id"]))
+    for bt in kept:
+        for root_id in sorted(entries(bt) - kept_roots):
+            items.append(prune_item("VCS root entry", project["name"],
+                                    f"{teamcity_url}/app/rest/buildTypes/id:{bt['id']}/vcs-root-entries/id:{root_id}",
+                                    f"VCS root {root_id} '{names.get(root_id, root_id)}' detached from {bt['id']}"))
+    for root in vcs_roots:
+        if root["id"] in used or root["id"] in kept_roots:
+            continue
+        if root["id"] in smoke_roots or root["name"] == root_name:
+            items.append(prune_item("VCS root", project["name"], f"{teamcity_url}/app/rest/vcs-roots/id:{root['id']}",
+                                    f"VCS root {root['id']} '{root['name']}'",
+                                    f"vcs-root:{project['id']}:{root['name']}", root["id"]))
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for bt in kept:
+        builds = restclient.find_items(read_for_write, f"{teamcity_url}/app/rest/builds", "build", "id,finishDate", headers,
+                                       fallback_locator=f"buildType:(id:{bt['id']}),state:finished,defaultFilter:false")
+        for build in builds[args.keep_builds:]:
+            finished = restclient.parse_date(build.get("finishDate"))
+            if args.keep_days and finished and now - finished < datetime.timedelta(days=args.keep_days):
+                continue
+            items.append(prune_item("build", project["name"], f"{teamcity_url}/app/rest/builds/id:{build['id']}",
+                                    f"build {build['id']} of {bt['id']}"))
+    return items
+
+# Deleted in this order so nothing is removed while something still references it
+PRUNE_ORDER = ("build", "build configuration", "VCS root entry", "VCS root", "BuildExecutor", "OAuthProvider")
+
+def plan_prune(args, specs, headers):
+    """
+    Find everything to prune in the manifest's projects and in projects no longer in
+    the manifest that still hold a connector this release created (see is_owned_connector).
+    """
+    by_name = {spec["name"]: spec for spec in specs}
+    fingerprint = credentials_fingerprint(*read_k8s_token_and_cacert(args.token_path, args.cacert_path))
+    with TELEMETRY.span("project listing"):
+        projects = restclient.find_items(read_for_write, f"{args.teamcity_url}/app/rest/projects", "project",
+                                         PROJECT_FIELDS, headers)
+    scope = [(project, by_name.get(project["name"])) for project in projects
+             if project["name"] in by_name or any(
+                 is_owned_connector(f, args.owner, fingerprint)
+                 for f in project.get("projectFeatures", {}).get("projectFeature", []))]
+
+    def plan(project, spec, log):
+        return stale_features(args.teamcity_url, project, spec, args.owner, fingerprint) + \
+            stale_smoke_artifacts(args.teamcity_url, project, spec, args, headers)
+
+    tasks = [(project["name"], functools.partial(plan, project, spec)) for project, spec in scope]
+    items, failures = [], []
+    for name, result, error in runner.run_in_order(tasks, args.concurrency):
+        if error:
+            failures.append((name, str(error)))
+        else:
+            items.extend(result)
+    return items, failures
+
+def print_prune_report(items, apply):
+    counts = {kind: sum(1 for i in items if i["kind"] == kind) for kind in PRUNE_ORDER}
+    print(f"Prune {'plan' if apply else 'report (dry run)'}: " +
+          ", ".join(f"{kind}: {count}" for kind, count in counts.items()))
+    for project in sorted({i["project"] for i in items}):
+        print(f"  {project}:")
+        for kind in PRUNE_ORDER:
+            matching = [i for i in items if i["project"] == project and i["kind"] == kind]
+            if kind == "build" and matching:
+                print(f"    {len(matching)} smoke test builds beyond retention")
+                continue
+            for item in matching:
+                print(f"    {item['description']}")
+
+def delete_items(items, headers, concurrency=1, batch_size=50, log=print):
+    """
+    Delete the items kind by kind in PRUNE_ORDER, each kind in batches of
+    `batch_size` DELETEs running `concurrency` at a time. Returns (description, error) failures.
+    """
+    def delete(item):
+        try:
+            body, status = make_request(item["url"], method="DELETE", headers=headers)
+        except Exception as e:
+            return str(e)
+        if status not in (200, 204, 404):
+            return f"status {status}: {body.decode(errors='replace')[:200]}"
+        if item["cache_key"] and (CACHE.get(item["cache_key"]) or {}).get("id") == item["id"]:
+            CACHE.invalidate(item["cache_key"])
+        return None
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for kind in PRUNE_ORDER:
+            pending = [i for i in items if i["kind"] == kind]
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                with TELEMETRY.span("prune batch", kind=kind, size=len(batch)):
+                    errors = list(pool.map(delete, batch))
+                failures.extend((f"{i['project']}: {i['description']}", e) for i, e in zip(batch, errors) if e)
+                log(f"Deleted {kind}: {start + len(batch) - sum(1 for e in errors if e)} of {len(pending)}")
+    CACHE.save()
+    return failures
 
 def main():
     parser = argparse.ArgumentParser(description="TeamCity + Kubernetes bootstrap")
     parser.add_argument("--teamcity-url", required=True)
-    parser.add_argument("--project-name", required=True)
-    parser.add_argument("--k8s-profile-name", required=True)
-    parser.add_argument("--k8s-api-server-url", required=True)
-    parser.add_argument("--k8s-namespace", required=True)
-    parser.add_argument("--k8s-builds-limit", required=True)
-    parser.add_argument("--k8s-container-parameters", required=True)
-    parser.add_argument("--k8s-template-name", required=True)
+    parser.add_argument("--manifest", default=None, help="JSON/YAML file with the list of projects to register")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of projects reconciled at once")
+    parser.add_argument("--cache-file", default=None, help="JSON file caching TeamCity ids between runs")
+    parser.add_argument("--owner", default=None,
+                        help=f"Written to the connectors' {MANAGED_BY} property; --prune only touches connectors with it "
+                             "or with the current credentials")
+    parser.add_argument("--force-rotate", action="store_true", help="Rewrite connector credentials even if their fingerprint is unchanged")
+    parser.add_argument("--project-name")
+    parser.add_argument("--k8s-profile-name")
+    parser.add_argument("--k8s-api-server-url")
+    parser.add_argument("--k8s-namespace")
+    parser.add_argument("--k8s-builds-limit")
+    parser.add_argument("--k8s-container-parameters")
+    parser.add_argument("--k8s-template-name")
     parser.add_argument("--api-token-path", default=None)
     parser.add_argument("--token-path", default="/var/run/secrets/kubernetes.io/serviceaccount/token")
     parser.add_argument("--cacert-path", default="/var/run/secrets/kubernetes.io/serviceaccount/ca.crt")
+    parser.add_argument("--shard-index", type=int, default=int(os.getenv("JOB_COMPLETION_INDEX", "0")),
+                        help="Shard reconciled by this process (default: $JOB_COMPLETION_INDEX)")
+    parser.add_argument("--shard-count", type=int, default=1, help="Number of shards the manifest is split into")
+    parser.add_argument("--watch", action="store_true", help="Keep running and reconcile manifest and credential changes (requires --manifest)")
+    parser.add_argument("--watch-interval", type=float, default=5, help="Seconds between checks for changes in --watch mode")
+    parser.add_argument("--debounce", type=float, default=10, help="Seconds without further changes before a batch is reconciled")
+    parser.add_argument("--resync-period", type=float, default=3600, help="Seconds between full reconciles in --watch mode (0 disables)")
+    parser.add_argument("--max-failure-delay", type=float, default=600, help="Longest delay before failed projects are retried in --watch mode")
+    preflight_mode = parser.add_mutually_exclusive_group()
+    preflight_mode.add_argument("--skip-preflight", action="store_true",
+                                help="Register without first checking namespaces, PodTemplates and permissions through the Kubernetes API")
+    preflight_mode.add_argument("--preflight-only", action="store_true", help="Only run the pre-flight checks")
+    parser.add_argument("--tune-builds-limit", action="store_true",
+                        help="Sample the build load and recommend a buildsLimit per executor instead of registering")
+    parser.add_argument("--tune-apply", action="store_true", help="Set the recommended buildsLimit on the executors")
+    parser.add_argument("--tune-duration", type=float, default=300, help="Seconds the build load is sampled for")
+    parser.add_argument("--tune-interval", type=float, default=15, help="Seconds between build load samples")
+    parser.add_argument("--tune-percentile", type=float, default=90, help="Percentile of the sampled demand aimed for")
+    parser.add_argument("--tune-headroom", type=int, default=1, help="Builds added to the sampled demand")
+    parser.add_argument("--min-builds-limit", type=int, default=1, help="Lowest buildsLimit recommended")
+    parser.add_argument("--max-builds-limit", type=int, default=20, help="Highest buildsLimit recommended")
+    parser.add_argument("--k8s-api-url", default=None, help="Kubernetes API server queried for quotas and nodes (default: in-cluster)")
+    parser.add_argument("--prune", action="store_true",
+                        help="Report connectors, executors and smoke test artifacts the manifest no longer declares instead of registering")
+    parser.add_argument("--prune-apply", action="store_true", help="Delete what --prune reports")
+    parser.add_argument("--prune-batch-size", type=int, default=50, help="DELETE requests per batch")
+    parser.add_argument("--keep-builds", type=int, default=10, help="Newest smoke test builds kept per project")
+    parser.add_argument("--keep-days", type=float, default=0,
+                        help="Also keep smoke test builds that finished within this many days (0: only --keep-builds)")
+    parser.add_argument("--smoke-build-config-name", default="SmokeTest", help="Build configuration name used by smoketest.py")
+    parser.add_argument("--smoke-vcs-root-name", default=None,
+                        help="Default VCS root name used by smoketest.py (default: <smoke-build-config-name>-Git)")
+    restclient.add_session_arguments(parser, rate_limit=10)
+    telemetry.add_arguments(parser)
     args = parser.parse_args()
+    if not 0 <= args.shard_index < max(1, args.shard_count):
+        parser.error(f"--shard-index must be between 0 and {args.shard_count - 1}")
 
-    if args.api_token_path:
-        with open(args.api_token_path, 'r') as f:
-            api_token = f.read().strip()
+    if args.watch:
+        if not args.manifest:
+            parser.error("--watch requires --manifest")
+        restclient.configure_session(SESSION, args)
+        CACHE.load(args.cache_file)
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+        watch(args, stop)
+        return
+
+    if args.manifest:
+        specs = runner.load_manifest(args.manifest)
     else:
-        api_token = os.getenv('API_TOKEN')
-        if not api_token:
-            raise RuntimeError("API token is not provided or found in environment variables.")
+        single = ["project_name", "k8s_profile_name", "k8s_api_server_url", "k8s_namespace",
+                  "k8s_builds_limit", "k8s_container_parameters", "k8s_template_name"]
+        missing = ["--" + a.replace("_", "-") for a in single if getattr(args, a) is None]
+        if missing:
+            parser.error(f"the following arguments are required without --manifest: {', '.join(missing)}")
+        specs = [{
+            "name": args.project_name,
+            "k8sProfile": {
+                "name": args.k8s_profile_name,
+                "apiServerUrl": args.k8s_api_server_url,
+                "namespace": args.k8s_namespace,
+                "buildsLimit": args.k8s_builds_limit,
+                "containerParameters": args.k8s_container_parameters,
+                "templateName": args.k8s_template_name
+            }
+        }]
 
+    api_token = read_api_token(args.api_token_path)
     token, cacert = read_k8s_token_and_cacert(args.token_path, args.cacert_path)
-    headers = TEAMCITY_HEADERS.copy()
-    headers["Authorization"] = f"Bearer {api_token}"
+    headers = teamcity_headers(api_token)
 
-    if not project_exists(args.teamcity_url, args.project_name, headers):
-        create_project(args.teamcity_url, args.project_name, headers)
-    else:
-        print(f"Project {args.project_name} already exists.")
-
-    project_id = get_project_id(args.teamcity_url, args.project_name, headers)
-    features = get_project_features(args.teamcity_url, project_id, headers)
-
-    k8s_profile = {
-        "name": args.k8s_profile_name,
-        "apiServerUrl": args.k8s_api_server_url,
-        "namespace": args.k8s_namespace,
-        "buildsLimit": args.k8s_builds_limit,
-        "containerParameters": args.k8s_container_parameters,
-        "templateName": args.k8s_template_name
-    }
+    restclient.configure_session(SESSION, args)
+    CACHE.load(shard_path(args.cache_file, args.shard_index, args.shard_count))
 
-    if not feature_exists(features, "displayName", k8s_profile["name"], "OAuthProvider"):
-        oauth_id = create_k8s_connector(args.teamcity_url, project_id, k8s_profile, token, cacert, headers) 
-    else:
-        print(f"Kubernetes cloud profile {k8s_profile['name']} already exists.")
-        oauth_id = next(
-            f["id"] for f in features["projectFeature"]
-            if f["type"] == "OAuthProvider" and
-               any(p["name"] == "displayName" and p["value"] == k8s_profile["name"]
-                   for p in f.get("properties", {}).get("property", []))
-        )
-        update_k8s_connector(args.teamcity_url, project_id, oauth_id, cacert, token, headers)
-    
-
-    if not feature_exists(features, "profileName", "k8s agent", "BuildExecutor"):
-        create_k8s_cloud_profile(args.teamcity_url, project_id, k8s_profile, oauth_id, headers)
-    else:
-        print("BuildExecutor feature 'k8s agent' already exists.")
+    prefix = "Summary"
+    grouping = {}
+    if args.prune:
+        items, failures = plan_prune(args, specs, headers)
+        print_prune_report(items, args.prune_apply)
+        if args.prune_apply:
+            failures += delete_items(items, headers, args.concurrency, args.prune_batch_size)
+        for name, error in failures:
+            print(f"  FAILED {name}: {error}")
+        print(SESSION.summary())
+        telemetry.export(TELEMETRY, SESSION, args, "prune")
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.tune_builds_limit:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+        failures = tune_builds_limits(args, specs, headers, stop)
+        for name, error in failures:
+            print(f"  FAILED {name}: {error}")
+        print(SESSION.summary())
+        telemetry.export(TELEMETRY, SESSION, args, "tune-builds-limit")
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.shard_count > 1:
+        total = len(specs)
+        specs = select_shard(specs, args.shard_index, args.shard_count)
+        prefix = f"Shard {args.shard_index + 1}/{args.shard_count} summary"
+        grouping = {"shard": str(args.shard_index)}
+        print(f"Shard {args.shard_index + 1}/{args.shard_count}: {len(specs)} of {total} projects.")
+
+    if not args.skip_preflight:
+        problems, _ = preflight(specs, args)
+        if problems or args.preflight_only:
+            if problems:
+                print(f"Pre-flight failed for {len(problems)} of {len(specs)} projects; nothing was written to TeamCity.")
+            print(SESSION.summary())
+            telemetry.export(TELEMETRY, SESSION, args, "add-project", grouping)
+            sys.exit(1 if problems else 0)
+    failures = reconcile_projects(args.teamcity_url, specs, token, cacert, headers, args.concurrency, args.force_rotate,
+                                  args.owner)
+    print_summary(specs, failures, prefix)
+    print(SESSION.summary())
+    telemetry.export(TELEMETRY, SESSION, args, "add-project", grouping)
+    if failures:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
-
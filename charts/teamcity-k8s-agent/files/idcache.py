@@ -0,0 +1,101 @@
+"""
+Optional on-disk cache of TeamCity object ids shared by the chart scripts.
+
+Maps names (projects, VCS roots, build configurations) to ids, together with an
+ETag when known. Entries are never trusted blindly: callers revalidate them with a
+cheap conditional or id-addressed GET, and a 404 invalidates the entry. With the
+file kept on a volume, repeated runs where nothing changed skip almost all
+collection listings.
+"""
+
+import os
+import json
+import threading
+
+
+class IdCache:
+    """
+    Thread-safe JSON file of {key: {"id": ..., "etag": ...}} entries.
+    Without a path the cache only lives for the current run.
+    """
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self.load(path)
+
+    def load(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f).get("entries", {})
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable id cache {path}: {e}")
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry else None
+
+    def set(self, key, object_id, etag=None):
+        entry = {"id": object_id}
+        if etag:
+            entry["etag"] = etag
+        with self._lock:
+            if self.entries.get(key) != entry:
+                self.entries[key] = entry
+                self._dirty = True
+
+    def invalidate(self, key):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def revalidate(self, session, key, url, headers, check=None):
+        """
+        Return the cached id for `key` if the object at `url` (built from the id with
+        `url.format(id=...)`) still exists and `check(body)` accepts it, else None.
+        Sends If-None-Match when an ETag is known; a 304 confirms the entry as is.
+        """
+        entry = self.get(key)
+        if entry is None:
+            self.record_lookup(hit=False)
+            return None
+
+        request_headers = dict(headers)
+        if entry.get("etag"):
+            request_headers["If-None-Match"] = entry["etag"]
+        response = session.request(url.format(id=entry["id"]), headers=request_headers)
+        if response.status == 304:
+            self.record_lookup(hit=True)
+            return entry["id"]
+        if response.status == 200 and (check is None or check(json.loads(response.body))):
+            self.set(key, entry["id"], response.headers.get("ETag"))
+            self.record_lookup(hit=True)
+            return entry["id"]
+        if response.status in (200, 404):
+            # Deleted, or the id now belongs to something else
+            self.invalidate(key)
+        self.record_lookup(hit=False)
+        return None
+
+    def record_lookup(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps({"entries": self.entries}, indent=2, sort_keys=True)
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
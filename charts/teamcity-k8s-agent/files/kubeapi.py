@@ -0,0 +1,208 @@
+"""
+Minimal Kubernetes API client for the chart scripts, authenticated with the pod's
+mounted service account token and CA (the same files add-project.py hands to
+TeamCity). Requests go through a restclient.Session of their own so they share the
+keep-alive pooling and retries but not the TeamCity session's CA or telemetry.
+"""
+
+import os
+import re
+import json
+import datetime
+import urllib.parse
+
+import restclient
+
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+QUANTITY_SUFFIXES = {
+    "n": 1e-9, "u": 1e-6, "m": 1e-3, "": 1, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15, "E": 1e18,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40, "Pi": 2 ** 50, "Ei": 2 ** 60,
+}
+
+
+def in_cluster_url():
+    host = os.getenv("KUBERNETES_SERVICE_HOST")
+    if not host:
+        return None
+    if ":" in host:
+        host = f"[{host}]"
+    return f"https://{host}:{os.getenv('KUBERNETES_SERVICE_PORT', '443')}"
+
+
+def parse_time(value):
+    """
+    Parse a Kubernetes RFC 3339 timestamp into an aware datetime (None stays None).
+    """
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def parse_quantity(value):
+    """
+    Parse a resource quantity ("500m", "25Gi", "2", "1e3") into a float.
+    """
+    match = re.fullmatch(r"([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)([a-zA-Z]*)", str(value).strip())
+    if not match or match.group(2) not in QUANTITY_SUFFIXES:
+        raise ValueError(f"Invalid quantity: {value}")
+    return float(match.group(1)) * QUANTITY_SUFFIXES[match.group(2)]
+
+
+def format_quantity(value, resource):
+    if "memory" in resource or "storage" in resource:
+        return f"{value / 2 ** 30:.1f}Gi"
+    if "cpu" in resource:
+        return f"{value * 1000:.0f}m"
+    return f"{value:g}"
+
+
+def current_namespace():
+    """
+    Namespace of the pod running the script, from the mounted service account.
+    """
+    try:
+        with open(f"{SERVICE_ACCOUNT_DIR}/namespace", 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def parse_duration(value):
+    """
+    Parse a Go duration as printed in kubelet events ("850ms", "12.3s", "1m2.5s") into seconds.
+    """
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 1e-3, "us": 1e-6, "µs": 1e-6, "ns": 1e-9}
+    parts = re.findall(r"([\d.]+)(h|ms|us|µs|ns|m|s)", value)
+    if not parts or "".join(n + u for n, u in parts) != value:
+        raise ValueError(f"Invalid duration: {value}")
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+PULLED_MESSAGE = re.compile(r'Successfully pulled image "([^"]+)" in ([\w.µ]+)')
+PRESENT_MESSAGE = re.compile(r'Container image "([^"]+)" already present on machine')
+
+
+def image_pulls(events):
+    """
+    Read kubelet "Pulled" events into (pod name, image, seconds) tuples, seconds being
+    None for images that were already present on the node.
+    """
+    pulls = []
+    for event in events:
+        if event.get("reason") != "Pulled":
+            continue
+        message, pod = event.get("message", ""), event.get("involvedObject", {}).get("name")
+        pulled, present = PULLED_MESSAGE.search(message), PRESENT_MESSAGE.search(message)
+        if pulled:
+            try:
+                pulls.append((pod, pulled.group(1), parse_duration(pulled.group(2))))
+            except ValueError:
+                continue
+        elif present:
+            pulls.append((pod, present.group(1), None))
+    return pulls
+
+
+def pod_resources(pod_spec):
+    """
+    What one pod with this spec counts against a ResourceQuota, keyed like the quota:
+    {"pods": 1, "requests.cpu": ..., "cpu": ..., "limits.memory": ..., ...}. A missing
+    request defaults to the limit and init containers count with their maximum, as
+    Kubernetes does.
+    """
+    def container_resources(container):
+        resources = container.get("resources") or {}
+        limits = {k: parse_quantity(v) for k, v in (resources.get("limits") or {}).items()}
+        requests = dict(limits, **{k: parse_quantity(v) for k, v in (resources.get("requests") or {}).items()})
+        return {"requests": requests, "limits": limits}
+
+    totals = {"pods": 1.0, "count/pods": 1.0}
+    for kind in ("requests", "limits"):
+        amounts = {}
+        for container in pod_spec.get("containers", []):
+            for resource, amount in container_resources(container)[kind].items():
+                amounts[resource] = amounts.get(resource, 0.0) + amount
+        for container in pod_spec.get("initContainers", []):
+            for resource, amount in container_resources(container)[kind].items():
+                amounts[resource] = max(amounts.get(resource, 0.0), amount)
+        for resource, amount in amounts.items():
+            totals[f"{kind}.{resource}"] = amount
+            if kind == "requests":
+                totals[resource] = amount
+    return totals
+
+
+def quota_shortfalls(quotas, needed, capacity=False):
+    """
+    Describe every ResourceQuota resource that has less room left than `needed`
+    (as returned by pod_resources); an empty list means the pod fits. With
+    `capacity` only quotas too small for the pod even when nothing else runs count.
+    """
+    problems = []
+    for quota in quotas:
+        status = quota.get("status", {})
+        hard, used = status.get("hard", {}), status.get("used", {})
+        for resource, amount in sorted(needed.items()):
+            if resource not in hard:
+                continue
+            limit = parse_quantity(hard[resource])
+            free = limit - parse_quantity(used.get(resource, "0"))
+            if amount > (limit if capacity else free):
+                problems.append(
+                    f"ResourceQuota {quota['metadata']['name']}: {resource} needs {format_quantity(amount, resource)} "
+                    f"but only {format_quantity(max(free, 0), resource)} of {format_quantity(limit, resource)} is free")
+    return problems
+
+
+class KubeError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class KubeClient:
+    """
+    GET/POST/PATCH JSON against the API server. The token is re-read for every
+    request because projected service account tokens are rotated in place.
+    """
+    def __init__(self, api_url=None, token_path=f"{SERVICE_ACCOUNT_DIR}/token",
+                 cacert_path=f"{SERVICE_ACCOUNT_DIR}/ca.crt", session=None):
+        self.api_url = (api_url or in_cluster_url() or "https://kubernetes.default.svc").rstrip("/")
+        self.token_path = token_path
+        self.session = session or restclient.Session(cafile=cacert_path if os.path.exists(cacert_path) else None)
+
+    def headers(self, content_type="application/json"):
+        with open(self.token_path, 'r') as f:
+            token = f.read().strip()
+        return {"Authorization": f"Bearer {token}", "Accept": "application/json", "Content-Type": content_type}
+
+    def request(self, path, method="GET", body=None, params=None, content_type="application/json"):
+        url = f"{self.api_url}{path}"
+        if params:
+            url += "?" + urllib.parse.urlencode({k: v for k, v in params.items() if v is not None})
+        data = json.dumps(body).encode() if body is not None else None
+        response = self.session.request(url, method=method, data=data, headers=self.headers(content_type))
+        if response.status >= 400:
+            try:
+                message = json.loads(response.body).get("message", "")
+            except ValueError:
+                message = response.body.decode(errors="replace")[:200]
+            raise KubeError(f"{method} {path} failed with status {response.status}: {message}", response.status)
+        return json.loads(response.body) if response.body else {}
+
+    def get(self, path, **params):
+        return self.request(path, params=params)
+
+    def list(self, path, **params):
+        """
+        All items of a collection, following `continue` tokens.
+        """
+        items = []
+        params.setdefault("limit", 500)
+        while True:
+            page = self.get(path, **params)
+            items.extend(page.get("items", []))
+            params["continue"] = page.get("metadata", {}).get("continue")
+            if not params["continue"]:
+                return items
@@ -0,0 +1,484 @@
+"""
+Shared HTTP layer for the chart scripts (add-project.py, smoketest.py).
+
+Keeps HTTP/1.1 connections alive and pooled per host, builds the TLS context once
+(optionally from a custom CA bundle), decodes gzip responses, applies connect/read
+timeouts and limits the request rate per host. A whole reconcile pass therefore
+reuses a handful of sockets instead of doing a TLS handshake per REST call.
+
+Transient failures (connection resets, timeouts, DNS errors, 502/503/504 while the
+HA nodes restart behind the proxy) are retried with exponential backoff and full
+jitter, honouring Retry-After. Only idempotent methods are retried unless the
+request never reached the server. A per-host circuit breaker holds requests back
+while a server recovers, and the session counts the retries of each run.
+
+With a NodeRouter, reads (build-status polls, queue samples) go to a secondary node
+of a TeamCity HA setup while writes, and the reads whose result feeds them, stay on
+the main node.
+"""
+
+import re
+import ssl
+import gzip
+import json
+import base64
+import time
+import datetime
+import random
+import socket
+import threading
+import collections
+import http.client
+import urllib.parse
+import email.utils
+
+Response = collections.namedtuple("Response", ["body", "status", "headers", "retries"], defaults=(0,))
+
+# Errors raised when a pooled keep-alive connection was closed by the server meanwhile
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+# Transport errors worth retrying (resets, timeouts and DNS failures are all OSErrors)
+TRANSIENT_ERRORS = (OSError, http.client.HTTPException)
+
+# Errors raised before the request reached the server, so any method can be retried
+CONNECT_ERRORS = (ConnectionRefusedError, socket.gaierror)
+
+# A wrong certificate will not fix itself
+PERMANENT_ERRORS = (ssl.SSLCertVerificationError,)
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+# Statuses answered by the proxy or a node that is (re)starting
+UNAVAILABLE_STATUSES = frozenset([502, 503, 504])
+
+READ_METHODS = frozenset(["GET", "HEAD"])
+
+# Cookie the HA proxy routes on (nginx-configmap.yaml in the teamcity chart)
+NODE_COOKIE = "X-TeamCity-Node-Id-Cookie"
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header (delta-seconds or an HTTP date), or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Decides whether an attempt is retried and how long to wait before the next one.
+    Idempotent methods are retried on transient errors and on 429/502/503/504; other
+    methods only when the request provably was not processed (connection refused,
+    DNS failure, 429) unless `retry_all_methods` is set.
+    """
+    def __init__(self, retries=6, backoff=1.0, max_backoff=30, max_retry_after=120, retry_all_methods=False):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.retry_all_methods = retry_all_methods
+
+    def should_retry(self, method, attempt, error=None, status=None):
+        if attempt >= self.retries:
+            return False
+        idempotent = self.retry_all_methods or method.upper() in IDEMPOTENT_METHODS
+        if error is not None:
+            if isinstance(error, PERMANENT_ERRORS):
+                return False
+            return idempotent or isinstance(error, CONNECT_ERRORS)
+        if status == 429:
+            return True
+        return idempotent and status in UNAVAILABLE_STATUSES
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Per-host breaker. After `threshold` consecutive failed attempts the host is left
+    alone for `cooldown` seconds: callers wait instead of sending requests, then a
+    single probe request decides whether the circuit closes or opens again.
+    A threshold of 0 disables the breaker.
+    """
+    def __init__(self, threshold=5, cooldown=10):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.opened = 0
+        self._hosts = {}
+        self._cond = threading.Condition()
+
+    def is_open(self, host):
+        with self._cond:
+            state = self._hosts.get(host)
+            if not self.threshold or not state or state["failures"] < self.threshold:
+                return False
+            return state["probing"] or state["open_until"] > time.monotonic()
+
+    def acquire(self, host):
+        if not self.threshold:
+            return
+        with self._cond:
+            while True:
+                state = self._hosts.setdefault(host, {"failures": 0, "open_until": 0.0, "probing": False})
+                if state["failures"] < self.threshold:
+                    return
+                wait = state["open_until"] - time.monotonic()
+                if wait <= 0 and not state["probing"]:
+                    state["probing"] = True
+                    return
+                self._cond.wait(wait if wait > 0 else 1)
+
+    def record(self, host, ok):
+        if not self.threshold:
+            return
+        with self._cond:
+            state = self._hosts.setdefault(host, {"failures": 0, "open_until": 0.0, "probing": False})
+            state["probing"] = False
+            if ok:
+                state["failures"] = 0
+            else:
+                state["failures"] += 1
+                now = time.monotonic()
+                if state["failures"] >= self.threshold and state["open_until"] <= now:
+                    state["open_until"] = now + self.cooldown
+                    self.opened += 1
+            self._cond.notify_all()
+
+
+class RateLimiter:
+    """
+    Per-host token bucket limiting how many requests per second are sent to each server.
+    A rate of 0 disables limiting.
+    """
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+class NodeRouter:
+    """
+    Routes read-only requests to a secondary node: directly through its own URL
+    (`read_url`, e.g. the <release>-secondary service) or through the proxy with the
+    node cookie (`node`, an upstream name such as "secondary_node"). Writes, and reads
+    whose result is written back (see Session.request), are left on the main node.
+    """
+    def __init__(self, read_url=None, node=None):
+        self.read_url = urllib.parse.urlsplit(read_url) if read_url else None
+        self.node = node
+
+    def __bool__(self):
+        return bool(self.read_url or self.node)
+
+    def route(self, url, method, headers):
+        """
+        Return (url, headers, breaker_key) for a read sent to the secondary, or None.
+        """
+        if not self or method.upper() not in READ_METHODS:
+            return None
+        parts = urllib.parse.urlsplit(url)
+        if self.read_url:
+            parts = parts._replace(scheme=self.read_url.scheme, netloc=self.read_url.netloc)
+        headers = dict(headers or {})
+        breaker_key = parts.netloc
+        if self.node:
+            cookie = f"{NODE_COOKIE}={self.node}"
+            headers["Cookie"] = f"{headers['Cookie']}; {cookie}" if headers.get("Cookie") else cookie
+            breaker_key = f"{parts.netloc}#{self.node}"
+        return urllib.parse.urlunsplit(parts), headers, breaker_key
+
+
+class Session:
+    """
+    Thread-safe pool of keep-alive connections, one idle list per (scheme, host, port).
+    """
+    def __init__(self, cafile=None, connect_timeout=10, read_timeout=60, rate_limit=0, max_idle_per_host=8):
+        self.max_idle_per_host = max_idle_per_host
+        self._pools = {}
+        self._lock = threading.Lock()
+        # Optional telemetry.Recorder notified of every request
+        self.recorder = None
+        self.configure(cafile, connect_timeout, read_timeout, rate_limit)
+
+    def configure(self, cafile=None, connect_timeout=10, read_timeout=60, rate_limit=0,
+                  retry_policy=None, circuit_breaker=None, router=None):
+        self.close()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.router = router or NodeRouter()
+        self.ssl_context = ssl.create_default_context(cafile=cafile)
+        self.counters = collections.Counter()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+    def _new_connection(self, scheme, host, port):
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=self.connect_timeout, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._pools.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(*key), False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._pools.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def summary(self):
+        """
+        One line with the request and retry counters of this run.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+        reasons = ", ".join(f"{k[len('retry:'):]}: {v}" for k, v in sorted(counters.items()) if k.startswith("retry:"))
+        line = f"REST: {counters.get('requests', 0)} requests, {counters.get('retries', 0)} retries"
+        if reasons:
+            line += f" ({reasons})"
+        line += f", {counters.get('gave_up', 0)} gave up, circuit opened {self.circuit_breaker.opened} times"
+        if self.router:
+            line += f", {counters.get('routed_reads', 0)} reads on the secondary ({counters.get('read_fallbacks', 0)} fell back to main)"
+        return line
+
+    def request(self, url, method="GET", data=None, headers=None, consistent=False):
+        """
+        Send one request and return a Response(body, status, headers, retries).
+        Transient failures are retried according to the retry policy; HTTP error
+        statuses left after that are returned, not raised, like the scripts always
+        expected.
+
+        Reads routed to a secondary get a single attempt there. If the node is down
+        or answers 404 (it may not have replicated a write made on the main node yet),
+        the read is repeated on the main node. A lagging secondary answers other reads
+        with old data, so `consistent=True` keeps a read on the main node: use it for
+        every read that decides or feeds a write.
+        """
+        start = time.monotonic()
+        try:
+            response = self._dispatch(url, method, data, headers, consistent)
+        except BaseException:
+            if self.recorder:
+                self.recorder.record_call(method, url, "error", start, time.monotonic(), len(data or b""), 0, 0)
+            raise
+        if self.recorder:
+            self.recorder.record_call(method, url, response.status, start, time.monotonic(),
+                                      len(data or b""), len(response.body), response.retries)
+        return response
+
+    def _dispatch(self, url, method, data, headers, consistent=False):
+        routed = None if consistent else self.router.route(url, method, headers)
+        if routed:
+            read_url, read_headers, breaker_key = routed
+            if not self.circuit_breaker.is_open(breaker_key):
+                try:
+                    response = self._request(read_url, method, data, read_headers, RetryPolicy(retries=0), breaker_key)
+                except TRANSIENT_ERRORS:
+                    response = None
+                if response is not None and response.status != 404 and response.status not in UNAVAILABLE_STATUSES:
+                    self.count("routed_reads")
+                    return response
+            self.count("read_fallbacks")
+        return self._request(url, method, data, headers, self.retry_policy)
+
+    def _request(self, url, method, data, headers, retry_policy, breaker_key=None):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        request_headers = {"Accept-Encoding": "gzip"}
+        request_headers.update(headers or {})
+
+        breaker_key = breaker_key or parts.netloc
+        attempt = 0
+        while True:
+            self.circuit_breaker.acquire(breaker_key)
+            self.rate_limiter.acquire(parts.netloc)
+            self.count("requests")
+            try:
+                response = self._send(key, method, path, data, request_headers)
+            except TRANSIENT_ERRORS as e:
+                self.circuit_breaker.record(breaker_key, ok=False)
+                if not retry_policy.should_retry(method, attempt, error=e):
+                    if retry_policy.retries:
+                        self.count("gave_up")
+                    raise
+                reason = type(e).__name__
+                delay = retry_policy.delay(attempt)
+            else:
+                self.circuit_breaker.record(breaker_key, ok=response.status not in UNAVAILABLE_STATUSES)
+                if not retry_policy.should_retry(method, attempt, status=response.status):
+                    if retry_policy.retries and (response.status in UNAVAILABLE_STATUSES or response.status == 429):
+                        self.count("gave_up")
+                    return response._replace(retries=attempt)
+                reason = f"HTTP {response.status}"
+                delay = retry_policy.delay(attempt, parse_retry_after(response.headers.get("Retry-After")))
+            self.count("retries")
+            self.count(f"retry:{reason}")
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, key, method, path, data, request_headers):
+        conn, reused = self._checkout(key)
+        try:
+            try:
+                conn.request(method, path, body=data, headers=request_headers)
+                response = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped an idle connection; retry once on a fresh one
+                conn = self._new_connection(*key)
+                conn.request(method, path, body=data, headers=request_headers)
+                response = conn.getresponse()
+            body = response.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return Response(body, response.status, response.headers)
+
+
+def locator_value(value):
+    """
+    Quote a value for a TeamCity locator. Plain names are used as is, anything that
+    could clash with the locator syntax (commas, colons, parentheses) is base64url-encoded.
+    """
+    value = str(value)
+    if re.fullmatch(r"[\w.\- ]+", value):
+        return value
+    return "$base64:" + base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def parse_date(value):
+    """
+    Parse a TeamCity REST date ("20240131T120000+0000") into an aware datetime (None stays None).
+    """
+    return datetime.datetime.strptime(value, "%Y%m%dT%H%M%S%z") if value else None
+
+
+def collection_url(url, locator=None, fields=None):
+    query = []
+    if locator:
+        query.append("locator=" + urllib.parse.quote(locator, safe=":,()$"))
+    if fields:
+        query.append("fields=" + urllib.parse.quote(fields, safe="(),"))
+    return f"{url}?{'&'.join(query)}" if query else url
+
+
+def find_items(request, url, item_key, fields, headers, locator=None, fallback_locator=None, match=None, page_size=500):
+    """
+    GET a TeamCity collection filtered server-side by `locator` and projected to
+    `fields` (the properties of each `item_key` entry). A server that rejects the
+    locator (HTTP 400) gets the paged listing of `fallback_locator` instead, filtered
+    here with `match`. `request` is the calling script's (body, status) request function.
+    """
+    projection = f"{item_key}({fields})"
+    if locator:
+        body, status = request(collection_url(url, locator, projection), headers=headers)
+        if status == 200:
+            return json.loads(body).get(item_key, [])
+        if status == 404:
+            return []
+        if status != 400:
+            raise RuntimeError(f"Failed to list {url}, status {status}")
+
+    items = []
+    start = 0
+    while True:
+        page = f"start:{start},count:{page_size}"
+        if fallback_locator:
+            page = f"{fallback_locator},{page}"
+        body, status = request(collection_url(url, page, projection), headers=headers)
+        if status == 404:
+            return items
+        if status != 200:
+            raise RuntimeError(f"Failed to list {url}, status {status}")
+        batch = json.loads(body).get(item_key, [])
+        items.extend(item for item in batch if match is None or match(item))
+        if len(batch) < page_size:
+            return items
+        start += page_size
+
+
+def add_session_arguments(parser, rate_limit=0):
+    parser.add_argument("--ca-bundle", default=None, help="CA bundle used to verify the TeamCity server certificate")
+    parser.add_argument("--connect-timeout", type=float, default=10, help="Connect timeout in seconds")
+    parser.add_argument("--read-timeout", type=float, default=60, help="Read timeout in seconds")
+    parser.add_argument("--rate-limit", type=float, default=rate_limit, help="Maximum requests per second per host (0 disables)")
+    parser.add_argument("--retries", type=int, default=6, help="Retries of a request after a transient failure")
+    parser.add_argument("--retry-backoff", type=float, default=1.0, help="Base of the exponential retry backoff in seconds")
+    parser.add_argument("--retry-all-methods", action="store_true", help="Also retry POST requests after a 502/503/504 or a reset")
+    parser.add_argument("--circuit-threshold", type=int, default=5, help="Consecutive failures that open the circuit breaker (0 disables)")
+    parser.add_argument("--circuit-cooldown", type=float, default=10, help="Seconds an open circuit waits before probing the server again")
+    parser.add_argument("--read-url", default=None, help="URL of a secondary node serving read-only requests (writes and the reads they depend on stay on --teamcity-url)")
+    parser.add_argument("--read-node", default=None, help=f"Proxy upstream for read-only requests, sent as the {NODE_COOKIE} cookie")
+
+
+def configure_session(session, args):
+    session.configure(
+        args.ca_bundle, args.connect_timeout, args.read_timeout, args.rate_limit,
+        retry_policy=RetryPolicy(args.retries, args.retry_backoff, retry_all_methods=args.retry_all_methods),
+        circuit_breaker=CircuitBreaker(args.circuit_threshold, args.circuit_cooldown),
+        router=NodeRouter(args.read_url, args.read_node),
+    )
@@ -0,0 +1,66 @@
+"""
+Shared plumbing for the chart scripts: loading the rendered project manifest and
+running one task per project on a bounded worker pool, with each project's output
+prefixed by its name and printed in manifest order.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ProjectLog:
+    """
+    Collects the output of one project so that concurrent runs print in manifest order,
+    each line prefixed with the project name.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lines = []
+
+    def __call__(self, message):
+        self.lines.append(f"[{self.name}] {message}")
+
+
+def load_manifest(path):
+    """
+    Load the project list from a JSON or YAML manifest. The manifest is either the
+    list of `.Values.teamcity.projects` entries or a mapping holding it under
+    `projects` (or `teamcity.projects`).
+    """
+    with open(path, 'r') as f:
+        content = f.read()
+    try:
+        manifest = json.loads(content)
+    except ValueError:
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError(f"Manifest {path} is not valid JSON and PyYAML is not installed to read it as YAML.")
+        manifest = yaml.safe_load(content)
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get("teamcity", manifest).get("projects", [])
+    if not isinstance(manifest, list):
+        raise RuntimeError(f"Manifest {path} must contain a list of projects.")
+    return manifest or []
+
+
+def run_in_order(tasks, concurrency=1):
+    """
+    Run `(name, task)` pairs on a pool of `concurrency` workers; each task is called
+    with its ProjectLog. Output is printed per task in the given order as soon as it is
+    complete. Returns a list of (name, result, error) with error None on success.
+    """
+    logs = [ProjectLog(name) for name, _ in tasks]
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(task, log) for (_, task), log in zip(tasks, logs)]
+        for (name, _), log, future in zip(tasks, logs, futures):
+            try:
+                results.append((name, future.result(), None))
+            except Exception as e:
+                log(f"FAILED: {e}")
+                results.append((name, None, e))
+            for line in log.lines:
+                print(line, flush=True)
+    return results
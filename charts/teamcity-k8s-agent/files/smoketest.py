@@ -6,22 +6,67 @@ TeamCity Smoke Test Script
 Automates creation (if needed) of a build configuration and VCS root in TeamCity,
 adds a simple build step, triggers a build, and verifies success via the REST API.
 If the VCS root or build step already exists, updates their Git URL and script content.
+
+With --manifest every project that declares a smokeTest is tested in parallel, and
+per-phase timings (REST setup, queue wait, agent startup, build run) can be written
+as a JSON and JUnit XML report. --benchmark N instead queues N builds at once per
+project (optionally only for some --template) and reports cold-start latency
+percentiles (pod scheduled and ready from the agent pods, agent connected from its
+registration) and throughput, comparing the templates side by side;
+tools/fake_teamcity.py serves as a stub server for it.
+
+While a build is queued the agent pods and events of the profile namespace are
+inspected through the Kubernetes API with the mounted service account token, so a
+broken pod template (image that cannot be pulled, pod that cannot be scheduled,
+exhausted ResourceQuota) fails the test within seconds with the concrete cause.
+After the build the agent pod's image pull events show how long its images took to
+pull; images already present on the node (e.g. kept warm by the chart's pre-pull
+DaemonSets) are credited with the pull time measured for them elsewhere.
 """
 
 import os
+import re
+import sys
 import json
 import time
+import datetime
 import argparse
-import urllib.request
-import urllib.error
+import statistics
+import functools
+import xml.etree.ElementTree as ET
 
-def api_request(url, method="GET", headers=None, data=None):
-    req = urllib.request.Request(url, method=method, headers=headers or {}, data=data)
-    try:
-        with urllib.request.urlopen(req) as resp:
-            return resp.read(), resp.status
-    except urllib.error.HTTPError as e:
-        return e.read(), e.code
+import idcache
+import runner
+import kubeapi
+import stats
+import restclient
+import telemetry
+
+SESSION = restclient.Session()
+CACHE = idcache.IdCache()
+TELEMETRY = telemetry.Recorder()
+SESSION.recorder = TELEMETRY
+
+def api_request(url, method="GET", headers=None, data=None, consistent=False):
+    response = SESSION.request(url, method=method, headers=headers, data=data, consistent=consistent)
+    return response.body, response.status
+
+def read_for_write(url, headers=None):
+    """
+    GET from the main node, for reads whose result is written back or decides a write.
+    """
+    return api_request(url, headers=headers, consistent=True)
+
+def cached_id(key, url, check, lookup, headers):
+    """
+    Resolve an id through the id cache (revalidated against `url`), falling back to `lookup()`.
+    """
+    object_id = CACHE.revalidate(SESSION, key, url, headers, check)
+    if object_id is None:
+        object_id = lookup()
+        if object_id:
+            CACHE.set(key, object_id)
+    return object_id
 
 def get_token(token_file=None):
     if token_file:
@@ -34,29 +79,30 @@ def get_token(token_file=None):
 
 def get_project_id_by_name(teamcity_url, project_name, headers):
     url = f"{teamcity_url}/app/rest/projects"
-    body, status = api_request(url, headers=headers)
-    if status != 200:
-        raise Exception(f"Failed to get projects: {body.decode(errors='replace')}")
-    for proj in json.loads(body).get('project', []):
+    projects = restclient.find_items(
+        read_for_write, url, "project", "id,name", headers,
+        locator=f"name:{restclient.locator_value(project_name)}",
+        match=lambda p: p['name'] == project_name)
+    for proj in projects:
         if proj['name'] == project_name:
             return proj['id']
     raise Exception(f"Project with name '{project_name}' not found.")
 
 def find_vcs_root(teamcity_url, project_id, vcs_root_name, headers):
-    url = f"{teamcity_url}/app/rest/vcs-roots?locator=project:(id:{project_id})"
-    body, status = api_request(url, headers=headers)
-    if status == 404:
-        return None
-    if status != 200:
-        raise Exception(f"Failed to get vcs roots: {body.decode(errors='replace')}")
-    for vcs in json.loads(body).get('vcs-root', []):
+    url = f"{teamcity_url}/app/rest/vcs-roots"
+    vcs_roots = restclient.find_items(
+        read_for_write, url, "vcs-root", "id,name", headers,
+        locator=f"project:(id:{project_id}),name:{restclient.locator_value(vcs_root_name)}",
+        fallback_locator=f"project:(id:{project_id})",
+        match=lambda v: v['name'] == vcs_root_name)
+    for vcs in vcs_roots:
         if vcs['name'] == vcs_root_name:
             return vcs['id']
     return None
 
-def update_vcs_root(teamcity_url, vcs_root_id, new_git_url, headers):
+def update_vcs_root(teamcity_url, vcs_root_id, new_git_url, headers, log=print):
     url = f"{teamcity_url}/app/rest/vcs-roots/id:{vcs_root_id}"
-    body, status = api_request(url, headers=headers)
+    body, status = read_for_write(url, headers=headers)
     if status != 200:
         raise Exception(f"Failed to fetch VCS root for update: {body.decode(errors='replace')}")
     vcs_root = json.loads(body)
@@ -76,11 +122,11 @@ def update_vcs_root(teamcity_url, vcs_root_id, new_git_url, headers):
         body, status = api_request(put_url, method="PUT", headers=headers, data=data)
         if status not in (200, 201):
             raise Exception(f"Failed to update VCS root: {body.decode(errors='replace')}")
-        print(f"Updated VCS root {vcs_root_id} with new Git URL.")
+        log(f"Updated VCS root {vcs_root_id} with new Git URL.")
     else:
-        print(f"VCS root {vcs_root_id} Git URL already up to date.")
+        log(f"VCS root {vcs_root_id} Git URL already up to date.")
 
-def create_vcs_root(teamcity_url, project_id, vcs_root_name, git_url, headers):
+def create_vcs_root(teamcity_url, project_id, vcs_root_name, git_url, headers, log=print):
     url = f"{teamcity_url}/app/rest/vcs-roots"
     payload = {
         "name": vcs_root_name,
@@ -97,20 +143,22 @@ def create_vcs_root(teamcity_url, project_id, vcs_root_name, git_url, headers):
     body, status = api_request(url, method="POST", headers=headers, data=data)
     if status not in (200, 201):
         raise Exception(f"Failed to create vcs root: {body.decode(errors='replace')}")
-    print(f"Created VCS root: {vcs_root_name}")
+    log(f"Created VCS root: {vcs_root_name}")
     return json.loads(body)["id"]
 
 def find_build_config(teamcity_url, project_id, build_config_name, headers):
-    url = f"{teamcity_url}/app/rest/projects/id:{project_id}/buildTypes"
-    body, status = api_request(url, headers=headers)
-    if status != 200:
-        raise Exception(f"Failed to get build configs: {body.decode(errors='replace')}")
-    for bt in json.loads(body).get('buildType', []):
+    url = f"{teamcity_url}/app/rest/buildTypes"
+    build_types = restclient.find_items(
+        read_for_write, url, "buildType", "id,name", headers,
+        locator=f"project:(id:{project_id}),name:{restclient.locator_value(build_config_name)}",
+        fallback_locator=f"project:(id:{project_id})",
+        match=lambda bt: bt['name'] == build_config_name)
+    for bt in build_types:
         if bt['name'] == build_config_name:
             return bt['id']
     return None
 
-def create_build_config(teamcity_url, project_id, build_config_name, headers):
+def create_build_config(teamcity_url, project_id, build_config_name, headers, log=print):
     url = f"{teamcity_url}/app/rest/buildTypes"
     payload = {
         "name": build_config_name,
@@ -120,12 +168,12 @@ def create_build_config(teamcity_url, project_id, build_config_name, headers):
     body, status = api_request(url, method="POST", headers=headers, data=data)
     if status not in (200, 201):
         raise Exception(f"Failed to create build config: {body.decode(errors='replace')}")
-    print(f"Created build configuration: {build_config_name}")
+    log(f"Created build configuration: {build_config_name}")
     return json.loads(body)["id"]
 
-def attach_vcs_root(teamcity_url, build_type_id, vcs_root_id, headers):
+def attach_vcs_root(teamcity_url, build_type_id, vcs_root_id, headers, log=print):
     url = f"{teamcity_url}/app/rest/buildTypes/id:{build_type_id}/vcs-root-entries"
-    body, status = api_request(url, headers=headers)
+    body, status = read_for_write(restclient.collection_url(url, fields="vcs-root-entry(vcs-root(id))"), headers=headers)
     if status != 200:
         raise Exception(f"Failed to get vcs-root-entries: {body.decode(errors='replace')}")
     attached = any(entry['vcs-root']['id'] == vcs_root_id for entry in json.loads(body).get('vcs-root-entry', []))
@@ -135,13 +183,13 @@ def attach_vcs_root(teamcity_url, build_type_id, vcs_root_id, headers):
         body, status = api_request(url, method="POST", headers=headers, data=data)
         if status not in (200, 201):
             raise Exception(f"Failed to attach vcs root: {body.decode(errors='replace')}")
-        print(f"Attached VCS root {vcs_root_id} to build config {build_type_id}")
+        log(f"Attached VCS root {vcs_root_id} to build config {build_type_id}")
     else:
-        print(f"VCS root {vcs_root_id} already attached to build config {build_type_id}")
+        log(f"VCS root {vcs_root_id} already attached to build config {build_type_id}")
 
-def add_command_step(teamcity_url, build_type_id, headers, script_content="ls -la"):
+def add_command_step(teamcity_url, build_type_id, headers, script_content="ls -la", log=print):
     url = f"{teamcity_url}/app/rest/buildTypes/id:{build_type_id}/steps"
-    body, status = api_request(url, headers=headers)
+    body, status = read_for_write(restclient.collection_url(url, fields="step(type,properties(property(name,value)))"), headers=headers)
     if status != 200:
         raise Exception(f"Failed to get build steps: {body.decode(errors='replace')}")
     steps = json.loads(body).get('step', [])
@@ -165,17 +213,18 @@ def add_command_step(teamcity_url, build_type_id, headers, script_content="ls -l
         body, status = api_request(url, method="POST", headers=headers, data=data)
         if status not in (200, 201):
             raise Exception(f"Failed to add build step: {body.decode(errors='replace')}")
-        print(f"Added command step to build config {build_type_id}")
+        log(f"Added command step to build config {build_type_id}")
     else:
-        print(f"Command step already exists in build config {build_type_id}")
+        log(f"Command step already exists in build config {build_type_id}")
 
-def update_command_step(teamcity_url, build_type_id, headers, script_content="ls -la"):
-    # Fetch the build configuration (get steps with IDs)
-    url = f"{teamcity_url}/app/rest/buildTypes/id:{build_type_id}"
-    body, status = api_request(url, headers=headers)
+def update_command_step(teamcity_url, build_type_id, headers, script_content="ls -la", log=print):
+    # Fetch only the steps of the build configuration (with IDs), not the whole build type
+    url = f"{teamcity_url}/app/rest/buildTypes/id:{build_type_id}/steps"
+    body, status = read_for_write(url, headers=headers)
     if status != 200:
         raise Exception(f"Failed to get build steps: {body.decode(errors='replace')}")
-    steps = json.loads(body).get('steps', {'step': []})
+    steps = json.loads(body)
+    steps.setdefault('step', [])
 
     # Only update the first simpleRunner step
     for step in steps['step']:
@@ -198,16 +247,208 @@ def update_command_step(teamcity_url, build_type_id, headers, script_content="ls
                 resp, put_status = api_request(step_url, method="PUT", headers=headers, data=step_data)
                 if put_status not in (200, 201):
                     raise Exception(f"Failed to update build step: {resp.decode(errors='replace')}")
-                print(f"Updated build step script content for build config {build_type_id}")
+                log(f"Updated build step script content for build config {build_type_id}")
             else:
-                print("Build step script content already up to date.")
+                log("Build step script content already up to date.")
             return
 
     # If you want to strictly update only, and no step found:
     raise Exception("No simpleRunner step found to update.")
 
 
-def trigger_and_wait_for_build(teamcity_url, build_type_id, headers):
+def agent_starting(wait_reason):
+    # TeamCity reports cloud agent startup with reasons like "Waiting for the starting agent"
+    reason = (wait_reason or "").lower()
+    return "agent" in reason and "start" in reason
+
+# Container waiting reasons that will not resolve while the build waits
+FATAL_WAITING_REASONS = {"ImagePullBackOff", "InvalidImageName", "ErrImageNeverPull", "CreateContainerConfigError"}
+# ErrImagePull messages that mean the image will never be pulled
+PERMANENT_PULL_ERROR = re.compile(r"not found|manifest unknown|unauthorized|denied|no such host", re.IGNORECASE)
+
+class AgentPodError(Exception):
+    pass
+
+class PodInspector:
+    """
+    Looks at the agent pods of a profile namespace while a build is queued and raises
+    AgentPodError as soon as the build cannot start: a container image that cannot be
+    pulled, a pod that stays unschedulable without the cluster autoscaler scaling up,
+    or a ResourceQuota without room for the agent pod.
+    Only pods matching `selector` (by default the labels of the pod template) are taken
+    for the build's agent; without either, only the ResourceQuota is checked, as other
+    workloads may share the namespace.
+    Inspection switches itself off if the Kubernetes API is not reachable or allowed.
+    """
+    def __init__(self, kube, namespace, template_name=None, selector=None, grace=10, log=print):
+        self.kube = kube
+        self.namespace = namespace
+        self.template_name = template_name
+        self.selector = selector or None
+        self.grace = grace
+        self.log = log
+        self.started = time.monotonic()
+        # Pods created before the build was queued are not its agents (allowing for clock skew)
+        self.since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+        self.unschedulable_since = {}
+        self.pod_needs = None
+        self.template = None
+        self.quota_reported = False
+        self.disabled = False
+
+    def check(self):
+        if self.disabled:
+            return
+        try:
+            self.inspect()
+        except (kubeapi.KubeError, *restclient.TRANSIENT_ERRORS) as e:
+            self.log(f"Not inspecting agent pods in {self.namespace}: {e}")
+            self.disabled = True
+
+    def events(self):
+        events = self.kube.list(f"/api/v1/namespaces/{self.namespace}/events")
+        return [e for e in events
+                if (kubeapi.parse_time(e.get("lastTimestamp") or e.get("eventTime")
+                                       or e["metadata"].get("creationTimestamp")) or self.since) >= self.since]
+
+    def pod_template(self):
+        if self.template is None:
+            self.template = {}
+            if self.template_name:
+                self.template = self.kube.get(f"/api/v1/namespaces/{self.namespace}/podtemplates/{self.template_name}")
+        return self.template
+
+    def agent_selector(self):
+        if self.selector is None:
+            labels = self.pod_template().get("template", {}).get("metadata", {}).get("labels", {})
+            self.selector = ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+            if not self.selector:
+                self.log(f"Not inspecting agent pods in {self.namespace}: no label selector for them; "
+                         "only the ResourceQuota is checked")
+        return self.selector
+
+    def agent_pods(self):
+        """
+        Agent pods created since the inspector was set up (none without a selector).
+        """
+        if not self.agent_selector():
+            return []
+        return [p for p in self.kube.list(f"/api/v1/namespaces/{self.namespace}/pods", labelSelector=self.selector)
+                if kubeapi.parse_time(p["metadata"].get("creationTimestamp")) >= self.since]
+
+    def inspect(self):
+        now = time.monotonic()
+        pods = self.agent_pods()
+        events = None
+        for pod in pods:
+            name = pod["metadata"]["name"]
+            status = pod.get("status", {})
+            if status.get("phase") == "Failed":
+                raise AgentPodError(f"Agent pod {name} failed: {status.get('reason')}: {status.get('message')}")
+            for container in status.get("initContainerStatuses", []) + status.get("containerStatuses", []):
+                waiting = container.get("state", {}).get("waiting") or {}
+                reason, message = waiting.get("reason"), waiting.get("message", "")
+                if reason in FATAL_WAITING_REASONS or (reason == "ErrImagePull" and PERMANENT_PULL_ERROR.search(message)):
+                    raise AgentPodError(f"Agent pod {name} container {container['name']}: {reason}: {message}")
+
+            scheduled = next((c for c in status.get("conditions", []) if c.get("type") == "PodScheduled"), {})
+            if scheduled.get("status") == "False" and scheduled.get("reason") == "Unschedulable":
+                if now - self.unschedulable_since.setdefault(name, now) >= self.grace:
+                    events = events if events is not None else self.events()
+                    if not any(e.get("reason") == "TriggeredScaleUp" and e["involvedObject"].get("name") == name for e in events):
+                        raise AgentPodError(f"Agent pod {name} is unschedulable: {scheduled.get('message')}")
+            else:
+                self.unschedulable_since.pop(name, None)
+
+        if not pods and now - self.started >= self.grace:
+            # No agent pod at all: the quota may leave no room for it
+            quotas = self.kube.list(f"/api/v1/namespaces/{self.namespace}/resourcequotas")
+            problems = kubeapi.quota_shortfalls(quotas, self.agent_pod_needs(), capacity=True)
+            if problems:
+                raise AgentPodError("No agent pod can be created: " + "; ".join(problems))
+            # A full quota may free up as other builds finish, so it is only reported
+            problems = kubeapi.quota_shortfalls(quotas, self.agent_pod_needs())
+            if problems and not self.quota_reported:
+                self.log("Agent pod is waiting for quota: " + "; ".join(problems))
+                self.quota_reported = True
+
+    def image_pulls(self, pod_name):
+        """
+        (image, seconds) of the agent pod's containers, seconds None when already present.
+        """
+        if self.disabled:
+            return []
+        try:
+            events = self.kube.list(f"/api/v1/namespaces/{self.namespace}/events",
+                                    fieldSelector=f"involvedObject.name={pod_name}")
+        except (kubeapi.KubeError, *restclient.TRANSIENT_ERRORS) as e:
+            self.log(f"Could not read image pulls of {pod_name}: {e}")
+            return []
+        return [(image, seconds) for _, image, seconds in kubeapi.image_pulls(events)]
+
+    def agent_pod_needs(self):
+        if self.pod_needs is None:
+            self.pod_needs = {"pods": 1.0, "count/pods": 1.0}
+            if self.template_name:
+                self.pod_needs = kubeapi.pod_resources(self.pod_template().get("template", {}).get("spec", {}))
+        return self.pod_needs
+
+def wait_for_build(teamcity_url, build_id, headers, timeout=300, poll_interval=0.5, max_poll_interval=10, backoff=1.5,
+                   inspector=None, inspect_interval=2, log=print):
+    """
+    Poll a build until it finishes or `timeout` seconds pass. Polling starts at
+    `poll_interval` and backs off up to `max_poll_interval`, restarting fast when the
+    build changes phase, so short builds are reported as soon as they are done.
+    Returns the final build with the measured phases in seconds: "queue_wait" (until an
+    agent is starting for it), "agent_startup" (until it starts) and "run_time".
+    While the build is queued `inspector.check()` runs at least every `inspect_interval`
+    seconds and may abort the wait with the reason the agent cannot start.
+    """
+    url = restclient.collection_url(f"{teamcity_url}/app/rest/builds/id:{build_id}", fields="state,status,waitReason,agent(name)")
+    queued_at = time.monotonic()
+    deadline = queued_at + timeout
+    agent_starting_at = None
+    started_at = None
+    wait_reason = None
+    interval = poll_interval
+    while True:
+        body, status = api_request(url, headers=headers)
+        if status != 200:
+            raise Exception(f"Failed to get build status: {body.decode(errors='replace')}")
+        build = json.loads(body)
+        now = time.monotonic()
+
+        if build["state"] == "queued" and build.get("waitReason") != wait_reason:
+            wait_reason = build.get("waitReason")
+            log(f"Build {build_id} queued: {wait_reason}")
+            if agent_starting_at is None and agent_starting(wait_reason):
+                agent_starting_at = now
+                interval = poll_interval
+        if build["state"] != "queued" and started_at is None:
+            started_at = now
+            interval = poll_interval
+            log(f"Build {build_id} started after {started_at - queued_at:.1f}s in queue")
+        if build["state"] == "finished":
+            build["queue_wait"] = (agent_starting_at or started_at) - queued_at
+            build["agent_startup"] = started_at - agent_starting_at if agent_starting_at else 0.0
+            build["run_time"] = now - started_at
+            TELEMETRY.add_span("queue wait", queued_at, agent_starting_at or started_at, build=build_id)
+            if agent_starting_at:
+                TELEMETRY.add_span("agent startup", agent_starting_at, started_at, build=build_id)
+            TELEMETRY.add_span("build run", started_at, now, build=build_id)
+            return build
+
+        if build["state"] == "queued" and inspector is not None:
+            inspector.check()
+            interval = min(interval, inspect_interval)
+
+        if now >= deadline:
+            raise TimeoutError(f"Build {build_id} did not finish within {timeout}s (state: {build['state']})")
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * backoff, max_poll_interval)
+
+def trigger_and_wait_for_build(teamcity_url, build_type_id, headers, timeout=300, poll_interval=0.5, max_poll_interval=10,
+                               inspector=None, log=print):
     trigger_url = f"{teamcity_url}/app/rest/buildQueue"
     payload = {"buildType": {"id": build_type_id}}
     data = json.dumps(payload).encode()
@@ -215,34 +456,429 @@ def trigger_and_wait_for_build(teamcity_url, build_type_id, headers):
     if status not in (200, 201):
         raise Exception(f"Failed to trigger build: {body.decode(errors='replace')}")
     build_id = json.loads(body)["id"]
-    print(f"Triggered build {build_id} for build config {build_type_id}")
+    log(f"Triggered build {build_id} for build config {build_type_id}")
 
-    build_url = f"{teamcity_url}/app/rest/builds/id:{build_id}"
-    for _ in range(30):  # wait max 5 minutes
-        body, status = api_request(build_url, headers=headers)
-        if status != 200:
-            raise Exception(f"Failed to get build status: {body.decode(errors='replace')}")
-        state = json.loads(body)["state"]
-        if state == "finished":
-            status_ = json.loads(body)["status"]
-            print(f"Build finished with status: {status_}")
-            if status_ != "SUCCESS":
-                raise Exception(f"Build finished with status: {status_}")
-            break
-        time.sleep(10)
-    else:
-        raise TimeoutError("Build did not finish in time")
+    try:
+        build = wait_for_build(teamcity_url, build_id, headers, timeout, poll_interval, max_poll_interval,
+                               inspector=inspector, log=log)
+    except AgentPodError:
+        cancel_build(teamcity_url, build_id, headers, log=log)
+        raise
+    status_ = build["status"]
+    log(f"Build finished with status: {status_} (queue wait {build['queue_wait']:.1f}s, "
+        f"agent startup {build['agent_startup']:.1f}s, run time {build['run_time']:.1f}s)")
+    if status_ != "SUCCESS":
+        raise Exception(f"Build finished with status: {status_}")
+    return build
+
+def setup_build_config(teamcity_url, test, headers, log=print):
+    """
+    Find or create the project's VCS root and build configuration for the smoke test
+    and return the build configuration id.
+    """
+    # Resolve project ID by name
+    with TELEMETRY.span("project lookup", project=test['project']):
+        project_id = cached_id(
+            f"project:{test['project']}",
+            f"{teamcity_url}/app/rest/projects/id:{{id}}?fields=id,name",
+            lambda p: p['name'] == test['project'],
+            lambda: get_project_id_by_name(teamcity_url, test['project'], headers),
+            headers)
+
+    # VCS root: create or update
+    with TELEMETRY.span("vcs setup", project=test['project']):
+        vcs_root_key = f"vcs-root:{project_id}:{test['vcsRootName']}"
+        vcs_root_id = cached_id(
+            vcs_root_key,
+            f"{teamcity_url}/app/rest/vcs-roots/id:{{id}}?fields=id,name,project(id)",
+            lambda v: v['name'] == test['vcsRootName'] and v.get('project', {}).get('id') == project_id,
+            lambda: find_vcs_root(teamcity_url, project_id, test['vcsRootName'], headers),
+            headers)
+        if vcs_root_id:
+            update_vcs_root(teamcity_url, vcs_root_id, test['gitUrl'], headers, log=log)
+        else:
+            vcs_root_id = create_vcs_root(teamcity_url, project_id, test['vcsRootName'], test['gitUrl'], headers, log=log)
+            CACHE.set(vcs_root_key, vcs_root_id)
+
+    # Build config: create or update
+    with TELEMETRY.span("build config setup", project=test['project']):
+        build_type_key = f"buildType:{project_id}:{test['buildConfigName']}"
+        build_type_id = cached_id(
+            build_type_key,
+            f"{teamcity_url}/app/rest/buildTypes/id:{{id}}?fields=id,name,projectId",
+            lambda bt: bt['name'] == test['buildConfigName'] and bt.get('projectId') == project_id,
+            lambda: find_build_config(teamcity_url, project_id, test['buildConfigName'], headers),
+            headers)
+        if not build_type_id:
+            build_type_id = create_build_config(teamcity_url, project_id, test['buildConfigName'], headers, log=log)
+            CACHE.set(build_type_key, build_type_id)
+            add_command_step(teamcity_url, build_type_id, headers, test['command'], log=log)
+        else:
+            # always update script content
+            update_command_step(teamcity_url, build_type_id, headers, test['command'], log=log)
+
+        # Attach VCS root if not already attached
+        attach_vcs_root(teamcity_url, build_type_id, vcs_root_id, headers, log=log)
+    return build_type_id
+
+def cancel_build(teamcity_url, build_id, headers, log=print):
+    data = json.dumps({"comment": "Smoke test aborted: agent pod cannot start", "readdIntoQueue": False}).encode()
+    body, status = api_request(f"{teamcity_url}/app/rest/buildQueue/id:{build_id}", method="POST", headers=headers, data=data)
+    if status not in (200, 201, 204, 404):
+        log(f"Failed to cancel queued build {build_id}: status {status}")
+
+def pod_inspector(kube, test, inspect_options=None, log=print):
+    """
+    A PodInspector for the test's agent pods, None without Kubernetes access or namespace.
+    """
+    if kube is None or not test.get('namespace'):
+        return None
+    options = dict(inspect_options or {})
+    if options.get("selector") and "{template}" in options["selector"]:
+        options["selector"] = options["selector"].replace("{template}", test['template']) if test['template'] else None
+    return PodInspector(kube, test['namespace'], test['template'], log=log, **options)
+
+def run_smoke_test(teamcity_url, test, headers, poll_interval, max_poll_interval, result, log=print, kube=None, inspect_options=None):
+    """
+    Set up and run one project's smoke test, recording phase timings in `result`
+    as they complete so that a failed run still reports how far it got.
+    """
+    phases = result["phases"]
+    started = time.monotonic()
+    try:
+        build_type_id = setup_build_config(teamcity_url, test, headers, log=log)
+        phases["rest_setup"] = round(time.monotonic() - started, 3)
+
+        inspector = pod_inspector(kube, test, inspect_options, log=log)
+        build = trigger_and_wait_for_build(teamcity_url, build_type_id, headers,
+                                           test['timeout'], poll_interval, max_poll_interval, inspector=inspector, log=log)
+        phases["queue_wait"] = round(build["queue_wait"], 3)
+        phases["agent_startup"] = round(build["agent_startup"], 3)
+        phases["build_run"] = round(build["run_time"], 3)
+        agent_name = (build.get("agent") or {}).get("name")
+        if inspector is not None and agent_name:
+            pulls = inspector.image_pulls(agent_name)
+            result["images"] = [{"image": image, "pull_seconds": seconds} for image, seconds in pulls]
+            if any(seconds is not None for _, seconds in pulls):
+                phases["image_pull"] = round(sum(seconds or 0.0 for _, seconds in pulls), 3)
+        log("Smoke test completed successfully.")
+    finally:
+        result["total"] = round(time.monotonic() - started, 3)
+
+BENCHMARK_MILESTONES = ("queued", "pod_scheduled", "container_ready", "agent_connected", "started", "finished")
+
+def trigger_build(teamcity_url, build_type_id, headers):
+    payload = {"buildType": {"id": build_type_id}}
+    data = json.dumps(payload).encode()
+    body, status = api_request(f"{teamcity_url}/app/rest/buildQueue", method="POST", headers=headers, data=data)
+    if status not in (200, 201):
+        raise Exception(f"Failed to trigger build: {body.decode(errors='replace')}")
+    return json.loads(body)["id"]
+
+def pod_milestones(pod):
+    """
+    When the pod was scheduled and its containers were ready (the Ready condition, else
+    the last container start), None for what has not happened yet.
+    """
+    status = pod.get("status", {})
+    conditions = {c.get("type"): c for c in status.get("conditions", []) if c.get("status") == "True"}
+    scheduled = kubeapi.parse_time(conditions.get("PodScheduled", {}).get("lastTransitionTime"))
+    ready = kubeapi.parse_time(conditions.get("Ready", {}).get("lastTransitionTime"))
+    if ready is None:
+        started = [kubeapi.parse_time(c.get("state", {}).get("running", {}).get("startedAt"))
+                   for c in status.get("containerStatuses", [])]
+        if started and all(started):
+            ready = max(started)
+    return {"pod_scheduled": scheduled, "container_ready": ready}
+
+def agent_registered_at(teamcity_url, agent_id, headers):
+    """
+    When the agent registered with the server, None if TeamCity does not say.
+    """
+    url = restclient.collection_url(f"{teamcity_url}/app/rest/agents/id:{agent_id}", fields="id,registrationTimestamp")
+    body, status = api_request(url, headers=headers)
+    if status != 200:
+        return None
+    return restclient.parse_date(json.loads(body).get("registrationTimestamp"))
+
+def benchmark_builds(teamcity_url, build_type_id, count, headers, timeout=600, poll_interval=0.5, inspector=None,
+                     log=print):
+    """
+    Queue `count` builds at once and record, for each one, the seconds since the burst
+    started at which it was queued, its agent pod was scheduled and its containers were
+    ready (from the pods `inspector` matches, as the agent's name is the pod's), its
+    agent registered with the server, and it started and finished. Pod and agent times
+    come from the Kubernetes and TeamCity clocks and are None when unknown.
+    """
+    burst_at = time.monotonic()
+    burst_time = datetime.datetime.now(datetime.timezone.utc)
+    deadline = burst_at + timeout
+    records = {}
+    for _ in range(count):
+        build_id = trigger_build(teamcity_url, build_type_id, headers)
+        records[build_id] = {"build_id": build_id, "status": None, "agent": None,
+                             "queued": time.monotonic() - burst_at}
+    log(f"Queued {count} builds for build config {build_type_id}")
+
+    pods, registered = {}, {}
+    pending = set(records)
+    while pending:
+        for build_id in sorted(pending):
+            url = restclient.collection_url(f"{teamcity_url}/app/rest/builds/id:{build_id}",
+                                            fields="state,status,agent(id,name)")
+            body, status = api_request(url, headers=headers)
+            if status != 200:
+                raise Exception(f"Failed to get build status: {body.decode(errors='replace')}")
+            build = json.loads(body)
+            record = records[build_id]
+            now = time.monotonic() - burst_at
+            agent = build.get("agent") or {}
+            if agent.get("name") and record["agent"] is None:
+                record["agent"] = agent["name"]
+                # Cloud agents are gone soon after their build, so ask while it runs
+                registered[agent["name"]] = agent_registered_at(teamcity_url, agent["id"], headers)
+            if build["state"] != "queued":
+                record.setdefault("started", now)
+            if build["state"] == "finished":
+                record["finished"] = now
+                record["status"] = build.get("status")
+                pending.discard(build_id)
+        if inspector is not None:
+            # Agent pods are deleted after their build; the conditions keep the exact times
+            try:
+                for pod in inspector.agent_pods():
+                    seen = pods.setdefault(pod["metadata"]["name"], {})
+                    for name, moment in pod_milestones(pod).items():
+                        if moment is not None:
+                            seen.setdefault(name, moment)
+            except (kubeapi.KubeError, *restclient.TRANSIENT_ERRORS) as e:
+                log(f"Not reading agent pods in {inspector.namespace}: {e}")
+                inspector = None
+        if pending and time.monotonic() >= deadline:
+            raise TimeoutError(f"{len(pending)} of {count} builds did not finish within {timeout}s")
+        if pending:
+            time.sleep(poll_interval)
+
+    for record in records.values():
+        moments = dict(pods.get(record["agent"], {}), agent_connected=registered.get(record["agent"]))
+        for name, moment in moments.items():
+            record[name] = (moment - burst_time).total_seconds() if moment is not None else None
+        for name in BENCHMARK_MILESTONES:
+            if record.get(name) is not None:
+                record[name] = round(record[name], 3)
+            else:
+                record[name] = None
+    return sorted(records.values(), key=lambda r: r["build_id"])
+
+def summarize_benchmark(records):
+    """
+    p50/p95/p99 of every milestone (None when never measured) and the finished-build
+    throughput per minute.
+    """
+    summary = {}
+    for name in BENCHMARK_MILESTONES:
+        values = [r[name] for r in records if r[name] is not None]
+        summary[name] = {f"p{pct}": round(stats.percentile(values, pct), 3) for pct in (50, 95, 99)} if values else None
+    last_finish = max((r["finished"] for r in records), default=0)
+    summary["throughput_per_min"] = round(len(records) * 60 / last_finish, 2) if last_finish else 0.0
+    summary["failed_builds"] = sum(1 for r in records if r["status"] != "SUCCESS")
+    return summary
+
+def compare_benchmarks(results):
+    """
+    Per milestone, every template's p50 and how far it is behind the fastest template,
+    plus the throughput of each. Projects sharing a template are told apart by name.
+    """
+    templates = [r["template"] for r in results]
+    labels = [r["template"] if r["template"] and templates.count(r["template"]) == 1
+              else f"{r['template'] or 'default'} ({r['project']})" for r in results]
+    comparison = {}
+    for name in BENCHMARK_MILESTONES[1:]:
+        p50 = {label: r["summary"][name]["p50"] for label, r in zip(labels, results) if r["summary"][name]}
+        if p50:
+            fastest = min(p50.values())
+            comparison[name] = {label: {"p50": value, "behind_fastest": round(value - fastest, 3)}
+                                for label, value in p50.items()}
+    comparison["throughput_per_min"] = {label: r["summary"]["throughput_per_min"] for label, r in zip(labels, results)}
+    return comparison
+
+def run_benchmark(teamcity_url, test, count, headers, poll_interval, kube=None, inspect_options=None, log=print):
+    build_type_id = setup_build_config(teamcity_url, test, headers, log=log)
+    inspector = pod_inspector(kube, test, inspect_options, log=log)
+    records = benchmark_builds(teamcity_url, build_type_id, count, headers, test['timeout'], poll_interval,
+                               inspector=inspector, log=log)
+    return {
+        "project": test["project"],
+        "template": test["template"],
+        "buildsLimit": test["buildsLimit"],
+        "containerParameters": test["containerParameters"],
+        "builds": records,
+        "summary": summarize_benchmark(records),
+    }
+
+def print_benchmark(results, comparison=None):
+    print("Benchmark (seconds since burst start, p50/p95/p99):")
+    for result in results:
+        summary = result["summary"]
+        print(f"  {result['project']} template={result['template']} buildsLimit={result['buildsLimit']}: "
+              f"{summary['throughput_per_min']} builds/min, {summary['failed_builds']} failed")
+        for name in BENCHMARK_MILESTONES:
+            latency = summary[name]
+            if latency is None:
+                print(f"    {name:16} {'n/a':>8}")
+            else:
+                print(f"    {name:16} {latency['p50']:8.1f} {latency['p95']:8.1f} {latency['p99']:8.1f}")
+    if comparison and len(results) > 1:
+        print("Template comparison (p50 seconds, + behind the fastest):")
+        for name, by_template in comparison.items():
+            if name == "throughput_per_min":
+                cells = [f"{label} {value}" for label, value in by_template.items()]
+                print(f"  {'builds/min':16} " + ", ".join(cells))
+            else:
+                cells = [f"{label} {latency['p50']:.1f} (+{latency['behind_fastest']:.1f})" for label, latency in by_template.items()]
+                print(f"  {name:16} " + ", ".join(cells))
+
+def smoke_tests_from_manifest(projects, args):
+    """
+    Turn manifest entries into smoke test settings, using the command line values as
+    defaults. Projects without a smokeTest.gitUrl are returned with gitUrl None (skipped).
+    """
+    tests = []
+    for project in projects:
+        smoke = project.get("smokeTest") or {}
+        profile = project.get("k8sProfile") or {}
+        tests.append({
+            "project": project["name"],
+            "template": profile.get("templateName"),
+            "namespace": profile.get("namespace") or args.namespace,
+            "buildsLimit": profile.get("buildsLimit"),
+            "containerParameters": profile.get("containerParameters"),
+            "gitUrl": smoke.get("gitUrl") or None,
+            "vcsRootName": smoke.get("vcsRootName") or args.vcs_root_name or f"{args.build_config_name}-Git",
+            "buildConfigName": args.build_config_name,
+            "command": smoke.get("command") or args.script_content,
+            "timeout": float(smoke.get("timeout") or args.timeout),
+        })
+    return tests
+
+def write_json_report(path, report):
+    data = json.dumps(report, indent=2)
+    if path == "-":
+        # The progress log went to stderr (see main), so stdout holds only the report
+        sys.__stdout__.write(data + "\n")
+        sys.__stdout__.flush()
+        return
+    with open(path, 'w') as f:
+        f.write(data)
+
+def write_junit_report(path, results):
+    suite = ET.Element("testsuite", {
+        "name": "teamcity-smoketest",
+        "tests": str(len(results)),
+        "failures": str(sum(1 for r in results if r["status"] == "failed")),
+        "skipped": str(sum(1 for r in results if r["status"] == "skipped")),
+        "time": f"{sum(r['total'] for r in results):.3f}",
+    })
+    for r in results:
+        case = ET.SubElement(suite, "testcase", {"classname": "smoketest", "name": r["name"], "time": f"{r['total']:.3f}"})
+        if r["status"] == "failed":
+            ET.SubElement(case, "failure", {"message": r["error"] or ""})
+        elif r["status"] == "skipped":
+            ET.SubElement(case, "skipped", {"message": r["error"] or ""})
+        ET.SubElement(case, "system-out").text = "\n".join(f"{k}={v:.3f}s" for k, v in r["phases"].items())
+    ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+def reference_pull_times(kube, namespace, selector, results, log=print):
+    """
+    Measured pull seconds per image: from the pre-pull DaemonSet pods matching
+    `selector` (as long as the API server still keeps their events) and from the agent
+    pods of this run that had to pull.
+    """
+    times = {}
+    for r in results:
+        for pull in r.get("images", []):
+            if pull["pull_seconds"] is not None:
+                times.setdefault(pull["image"], []).append(pull["pull_seconds"])
+    if kube is not None and namespace and selector:
+        try:
+            pods = {p["metadata"]["name"] for p in kube.list(f"/api/v1/namespaces/{namespace}/pods", labelSelector=selector)}
+            events = kube.list(f"/api/v1/namespaces/{namespace}/events", fieldSelector="reason=Pulled")
+        except (kubeapi.KubeError, *restclient.TRANSIENT_ERRORS) as e:
+            log(f"Could not read pre-pull image pulls: {e}")
+            return times
+        for pod, image, seconds in kubeapi.image_pulls(events):
+            if pod in pods and seconds is not None:
+                times.setdefault(image, []).append(seconds)
+    return times
+
+def add_pull_time_saved(results, reference):
+    """
+    Credit every image an agent pod found already present with the median pull time
+    measured for it; images never seen pulled are not counted.
+    """
+    for r in results:
+        present = [p["image"] for p in r.get("images", []) if p["pull_seconds"] is None]
+        if present:
+            r["pull_time_saved"] = round(sum(statistics.median(reference[i]) for i in present if i in reference), 3)
+
+def format_phases(phases):
+    return ", ".join(f"{name} {seconds:.1f}s" for name, seconds in phases.items())
 
 def main():
     parser = argparse.ArgumentParser(description="TeamCity Build Config Smoke Test")
     parser.add_argument("--teamcity-url", required=True, help="TeamCity server URL")
-    parser.add_argument("--project-name", required=True, help="TeamCity project name")
-    parser.add_argument("--git-url", required=True, help="Git repository URL")
+    parser.add_argument("--manifest", default=None, help="JSON/YAML file with the projects to test (entries with smokeTest.gitUrl)")
+    parser.add_argument("--project-name", help="TeamCity project name")
+    parser.add_argument("--git-url", help="Git repository URL")
     parser.add_argument("--build-config-name", default="SmokeTest", help="Build configuration name")
     parser.add_argument("--vcs-root-name", default=None, help="VCS root name (default: <build-config-name>-Git)")
     parser.add_argument("--script-content", default="ls -la", help="Shell command for build step")
     parser.add_argument("--token-file", default=None, help="Path to file containing TeamCity token (optional, else use TEAMCITY_TOKEN env var)")
+    parser.add_argument("--cache-file", default=None, help="JSON file caching TeamCity ids between runs")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the build to finish")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Initial build status poll interval in seconds")
+    parser.add_argument("--max-poll-interval", type=float, default=10, help="Maximum build status poll interval in seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of projects tested at once")
+    parser.add_argument("--report-json", default=None, help="Write a JSON report with per-phase timings to this file "
+                             "('-' for stdout, the progress log then goes to stderr)")
+    parser.add_argument("--junit-xml", default=None, help="Write a JUnit XML report to this file")
+    parser.add_argument("--benchmark", type=int, default=0, metavar="N",
+                        help="Instead of one smoke build, queue N builds at once per project and report start-up latencies")
+    parser.add_argument("--template", action="append", default=[],
+                        help="Only benchmark projects whose k8sProfile.templateName is this (repeatable)")
+    parser.add_argument("--namespace", default=None, help="Agent namespace to inspect (default: k8sProfile.namespace)")
+    parser.add_argument("--k8s-api-url", default=None, help="Kubernetes API server URL (default: in-cluster)")
+    parser.add_argument("--sa-token-path", default=f"{kubeapi.SERVICE_ACCOUNT_DIR}/token",
+                        help="Service account token used to inspect agent pods and events")
+    parser.add_argument("--sa-cacert-path", default=f"{kubeapi.SERVICE_ACCOUNT_DIR}/ca.crt",
+                        help="CA certificate of the Kubernetes API server")
+    parser.add_argument("--no-k8s-inspect", action="store_true",
+                        help="Do not watch agent pods and events while builds are queued")
+    parser.add_argument("--unschedulable-grace", type=float, default=10,
+                        help="Seconds an agent pod may stay unschedulable (or missing) before the test fails")
+    parser.add_argument("--agent-pod-selector", default=None,
+                        help="Label selector of agent pods, {template} standing for the test's pod template "
+                             "(default: the labels of the pod template)")
+    parser.add_argument("--prepull-selector", default=None,
+                        help="Label selector of the image pre-pull pods whose pull times count as time saved")
+    parser.add_argument("--prepull-namespace", default=None,
+                        help="Namespace of the image pre-pull pods (default: this pod's namespace)")
+    restclient.add_session_arguments(parser)
+    telemetry.add_arguments(parser)
     args = parser.parse_args()
+    if args.report_json == "-":
+        # Keep stdout parseable: everything but the report is printed to stderr
+        sys.stdout = sys.stderr
+    restclient.configure_session(SESSION, args)
+    CACHE.load(args.cache_file)
+
+    if args.manifest:
+        projects = runner.load_manifest(args.manifest)
+    elif args.project_name and args.git_url:
+        projects = [{"name": args.project_name, "smokeTest": {"gitUrl": args.git_url}}]
+    else:
+        parser.error("--project-name and --git-url are required without --manifest")
+    tests = smoke_tests_from_manifest(projects, args)
 
     token = get_token(args.token_file)
     headers = {
@@ -251,33 +887,82 @@ def main():
         "Authorization": f"Bearer {token}",
     }
 
-    # Resolve project ID by name
-    project_id = get_project_id_by_name(args.teamcity_url, args.project_name, headers)
-    vcs_root_name = args.vcs_root_name or f"{args.build_config_name}-Git"
+    kube = None
+    if not args.no_k8s_inspect:
+        if os.path.exists(args.sa_token_path):
+            kube = kubeapi.KubeClient(args.k8s_api_url, args.sa_token_path, args.sa_cacert_path)
+        else:
+            print(f"Not inspecting agent pods: no service account token at {args.sa_token_path}")
+    inspect_options = {"selector": args.agent_pod_selector, "grace": args.unschedulable_grace}
 
-    # VCS root: create or update
-    vcs_root_id = find_vcs_root(args.teamcity_url, project_id, vcs_root_name, headers)
-    if vcs_root_id:
-        update_vcs_root(args.teamcity_url, vcs_root_id, args.git_url, headers)
-    else:
-        vcs_root_id = create_vcs_root(args.teamcity_url, project_id, vcs_root_name, args.git_url, headers)
+    if args.benchmark:
+        # Templates are compared one after another so their pods don't compete for nodes
+        results = []
+        for test in tests:
+            if not test["gitUrl"] or (args.template and test["template"] not in args.template):
+                continue
+            results.append(run_benchmark(args.teamcity_url, test, args.benchmark, headers, args.poll_interval,
+                                         kube, inspect_options))
+        comparison = compare_benchmarks(results)
+        CACHE.save()
+        print_benchmark(results, comparison)
+        print(SESSION.summary())
+        telemetry.export(TELEMETRY, SESSION, args, "smoketest")
+        if args.report_json:
+            write_json_report(args.report_json, {"benchmarks": results, "comparison": comparison,
+                                                "rest": dict(SESSION.counters)})
+        if any(r["summary"]["failed_builds"] for r in results):
+            sys.exit(1)
+        return
 
-    # Build config: create or update
-    build_type_id = find_build_config(args.teamcity_url, project_id, args.build_config_name, headers)
-    if not build_type_id:
-        build_type_id = create_build_config(args.teamcity_url, project_id, args.build_config_name, headers)
-        add_command_step(args.teamcity_url, build_type_id, headers, args.script_content)
-    else:
-        # always update script content
-        update_command_step(args.teamcity_url, build_type_id, headers, args.script_content)
+    results = {test["project"]: {"name": test["project"], "status": "skipped", "error": None, "phases": {}, "total": 0.0}
+               for test in tests}
+    tasks = []
+    for test in tests:
+        if not test["gitUrl"]:
+            results[test["project"]]["error"] = "no smokeTest.gitUrl configured"
+            continue
+        tasks.append((test["project"], functools.partial(
+            run_smoke_test, args.teamcity_url, test, headers,
+            args.poll_interval, args.max_poll_interval, results[test["project"]],
+            kube=kube, inspect_options=inspect_options)))
 
-    # Attach VCS root if not already attached
-    attach_vcs_root(args.teamcity_url, build_type_id, vcs_root_id, headers)
+    for name, _, error in runner.run_in_order(tasks, args.concurrency):
+        result = results[name]
+        result["status"] = "failed" if error else "passed"
+        result["error"] = str(error) if error else None
+    CACHE.save()
 
-    # Trigger and wait for build
-    trigger_and_wait_for_build(args.teamcity_url, build_type_id, headers)
-    print("Smoke test completed successfully.")
+    results = list(results.values())
+    if kube is not None:
+        add_pull_time_saved(results, reference_pull_times(kube, args.prepull_namespace or kubeapi.current_namespace(),
+                                                          args.prepull_selector, results))
+    print("Smoke test summary: " + ", ".join(
+        f"{sum(1 for r in results if r['status'] == status)} {status}" for status in ("passed", "failed", "skipped")))
+    for r in results:
+        detail = format_phases(r["phases"]) if r["status"] != "skipped" else r["error"]
+        print(f"  {r['status'].upper():7} {r['name']}: {detail}")
+        if r["status"] == "failed":
+            print(f"          {r['error']}")
+        if r.get("images"):
+            present = sum(1 for p in r["images"] if p["pull_seconds"] is None)
+            print(f"          images: {len(r['images']) - present} pulled, {present} already present"
+                  + (f", ~{r['pull_time_saved']:.1f}s pull time saved" if r.get("pull_time_saved") else ""))
+    saved = [r["pull_time_saved"] for r in results if r.get("pull_time_saved")]
+    if saved:
+        print(f"Image pull time saved by warm nodes: ~{sum(saved):.1f}s over {len(saved)} agent pods")
+    print(SESSION.summary())
+    telemetry.export(TELEMETRY, SESSION, args, "smoketest")
+    if args.report_json:
+        write_json_report(args.report_json, {
+            "summary": {status: sum(1 for r in results if r["status"] == status) for status in ("passed", "failed", "skipped")},
+            "projects": results,
+            "rest": dict(SESSION.counters),
+        })
+    if args.junit_xml:
+        write_junit_report(args.junit_xml, results)
+    if any(r["status"] == "failed" for r in results):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
-
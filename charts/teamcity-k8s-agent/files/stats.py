@@ -0,0 +1,17 @@
+"""
+Small statistics helpers shared by the chart scripts (benchmark summaries in
+smoketest.py, demand estimates in tuning.py).
+"""
+
+
+def percentile(values, pct):
+    """
+    The `pct` percentile of `values`, interpolating linearly between the closest ranks.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
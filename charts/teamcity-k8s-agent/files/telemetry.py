@@ -0,0 +1,222 @@
+"""
+Metrics and traces for the chart scripts.
+
+A Recorder collects every REST call a restclient.Session makes (method, endpoint
+template, status, latency, bytes, retries) and named phase spans (project lookup,
+connector upsert, queue wait, ...). At the end of a run they can be written as a
+Prometheus text-format file, pushed to a Pushgateway and written as a Chrome trace
+(chrome://tracing, ui.perfetto.dev) with one track per worker thread.
+"""
+
+import re
+import json
+import time
+import threading
+import contextlib
+import urllib.parse
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def endpoint_template(url):
+    """
+    Reduce a REST URL to its endpoint template, e.g.
+    /app/rest/projects/id:Foo/projectFeatures/id:PROJECT_EXT_1 -> /app/rest/projects/id:{id}/projectFeatures/id:{id}
+    """
+    path = urllib.parse.urlsplit(url).path
+    path = re.sub(r"/(\w+):[^/]+", r"/\1:{\1}", path)
+    return re.sub(r"/\d+(?=/|$)", "/{n}", path)
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_string(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{label_value(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Recorder:
+    """
+    Thread-safe collector of REST calls and phase spans for one run.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.started_wall = time.time()
+        self.calls = []
+        self.spans = []
+
+    def reset(self):
+        """
+        Start a new run, e.g. after each batch of a long-running controller.
+        """
+        with self._lock:
+            self.started = time.monotonic()
+            self.started_wall = time.time()
+            self.calls = []
+            self.spans = []
+
+    def record_call(self, method, url, status, start, end, bytes_sent, bytes_received, retries):
+        call = {
+            "method": method,
+            "endpoint": endpoint_template(url),
+            "status": status,
+            "start": start,
+            "duration": end - start,
+            "bytes_sent": bytes_sent,
+            "bytes_received": bytes_received,
+            "retries": retries,
+            "thread": threading.get_ident(),
+        }
+        with self._lock:
+            self.calls.append(call)
+
+    def add_span(self, name, start, end, **args):
+        span = {"name": name, "start": start, "duration": end - start, "thread": threading.get_ident(), "args": args}
+        with self._lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.monotonic(), **args)
+
+    def prometheus(self, labels=None):
+        """
+        Render the run as Prometheus text exposition format.
+        """
+        labels = dict(labels or {})
+        with self._lock:
+            calls = list(self.calls)
+            spans = list(self.spans)
+
+        requests, retries, sent, received, latency = {}, {}, {}, {}, {}
+        for call in calls:
+            endpoint = (("method", call["method"]), ("endpoint", call["endpoint"]))
+            key = endpoint + (("status", str(call["status"])),)
+            requests[key] = requests.get(key, 0) + 1
+            retries[endpoint] = retries.get(endpoint, 0) + call["retries"]
+            sent[endpoint] = sent.get(endpoint, 0) + call["bytes_sent"]
+            received[endpoint] = received.get(endpoint, 0) + call["bytes_received"]
+            latency.setdefault(endpoint, []).append(call["duration"])
+        phases = {}
+        for span in spans:
+            phases.setdefault((("phase", span["name"]),), []).append(span["duration"])
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, key, value in samples:
+                lines.append(f"{name}{suffix}{label_string(dict(labels, **dict(key)))} {value:g}")
+
+        def histogram(durations):
+            for key, values in sorted(durations.items()):
+                for bucket in DURATION_BUCKETS:
+                    yield "_bucket", key + (("le", f"{bucket:g}"),), sum(1 for v in values if v <= bucket)
+                yield "_bucket", key + (("le", "+Inf"),), len(values)
+                yield "_sum", key, sum(values)
+                yield "_count", key, len(values)
+
+        metric("teamcity_rest_requests_total", "counter", "TeamCity REST calls by endpoint and final status",
+               (("", k, v) for k, v in sorted(requests.items())))
+        metric("teamcity_rest_request_duration_seconds", "histogram", "TeamCity REST call latency including retries",
+               histogram(latency))
+        metric("teamcity_rest_retries_total", "counter", "Retries of TeamCity REST calls",
+               (("", k, v) for k, v in sorted(retries.items())))
+        metric("teamcity_rest_request_bytes_total", "counter", "Request body bytes sent to TeamCity",
+               (("", k, v) for k, v in sorted(sent.items())))
+        metric("teamcity_rest_response_bytes_total", "counter", "Response body bytes received from TeamCity",
+               (("", k, v) for k, v in sorted(received.items())))
+        metric("teamcity_phase_duration_seconds", "histogram", "Duration of registration and smoke test phases",
+               histogram(phases))
+        metric("teamcity_run_duration_seconds", "gauge", "Wall time of the run",
+               [("", (), time.monotonic() - self.started)])
+        metric("teamcity_run_timestamp_seconds", "gauge", "Unix time the run started",
+               [("", (), self.started_wall)])
+        return "\n".join(lines) + "\n"
+
+    def chrome_trace(self, process_name):
+        """
+        Render the run as Chrome trace event JSON: spans and REST calls as complete
+        events on the track of the worker thread that made them.
+        """
+        with self._lock:
+            calls = list(self.calls)
+            spans = list(self.spans)
+
+        threads = {}
+        events = [{"ph": "M", "name": "process_name", "pid": 1, "tid": 0, "args": {"name": process_name}}]
+        for span in spans:
+            events.append({
+                "ph": "X", "cat": "phase", "name": span["name"], "pid": 1,
+                "tid": threads.setdefault(span["thread"], len(threads) + 1),
+                "ts": round((span["start"] - self.started) * 1e6), "dur": round(span["duration"] * 1e6),
+                "args": span["args"],
+            })
+        for call in calls:
+            events.append({
+                "ph": "X", "cat": "rest", "name": f"{call['method']} {call['endpoint']}", "pid": 1,
+                "tid": threads.setdefault(call["thread"], len(threads) + 1),
+                "ts": round((call["start"] - self.started) * 1e6), "dur": round(call["duration"] * 1e6),
+                "args": {k: call[k] for k in ("status", "bytes_sent", "bytes_received", "retries")},
+            })
+        for tid in threads.values():
+            events.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": tid, "args": {"name": f"worker-{tid}"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics-file", default=None, help="Write Prometheus text-format metrics of the run to this file")
+    parser.add_argument("--pushgateway-url", default=None, help="Push the run's metrics to this Prometheus Pushgateway")
+    parser.add_argument("--metrics-label", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra label added to every metric, e.g. chart_version=1.2.3 (repeatable)")
+    parser.add_argument("--trace-file", default=None, help="Write a Chrome/Perfetto trace JSON of the run to this file")
+
+
+def export(recorder, session, args, job, grouping=None):
+    """
+    Write and push what the command line asked for. `grouping` labels (e.g. the shard)
+    are added to the metrics and to the Pushgateway grouping key so that parallel
+    runs of one job do not replace each other. Export problems are reported but never
+    fail the run.
+    """
+    grouping = grouping or {}
+    labels = dict(label.split("=", 1) for label in args.metrics_label if "=" in label)
+    labels.update(grouping)
+    labels["script"] = job
+    text = recorder.prometheus(labels)
+    if args.metrics_file:
+        try:
+            with open(args.metrics_file, 'w') as f:
+                f.write(text)
+        except OSError as e:
+            print(f"Writing metrics to {args.metrics_file} failed: {e}")
+    if args.pushgateway_url:
+        url = f"{args.pushgateway_url.rstrip('/')}/metrics/job/{urllib.parse.quote(job, safe='')}"
+        for name, value in sorted(grouping.items()):
+            url += f"/{name}/{urllib.parse.quote(value, safe='')}"
+        # The push itself is not part of the run; later runs (--watch) record again
+        session_recorder, session.recorder = session.recorder, None
+        try:
+            response = session.request(url, method="PUT", data=text.encode(),
+                                       headers={"Content-Type": "text/plain; version=0.0.4"})
+            if response.status not in (200, 202):
+                print(f"Pushing metrics to {args.pushgateway_url} failed with status {response.status}")
+        except Exception as e:
+            print(f"Pushing metrics to {args.pushgateway_url} failed: {e}")
+        finally:
+            session.recorder = session_recorder
+    if args.trace_file:
+        try:
+            with open(args.trace_file, 'w') as f:
+                json.dump(recorder.chrome_trace(job), f)
+        except OSError as e:
+            print(f"Writing trace to {args.trace_file} failed: {e}")
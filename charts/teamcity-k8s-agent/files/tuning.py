@@ -0,0 +1,137 @@
+"""
+buildsLimit tuning for the Kubernetes executors registered by add-project.py.
+
+Samples of the build queue and of the running builds of each project (one
+BuildExecutor each) are reduced to the number of builds the project wanted to run
+at once, then capped by how many agent pods the namespace ResourceQuota and the
+nodes the pod template can be scheduled on hold, and clamped to configured bounds.
+"""
+
+import math
+
+import stats
+import kubeapi
+
+
+def classify_wait_reason(reason):
+    """
+    Bucket a TeamCity queue wait reason: "starting" (an agent is being started for the
+    build, so it holds an executor slot), "limit" (a limit such as buildsLimit keeps it
+    waiting), "agents" (no compatible agent) or "other".
+    """
+    reason = (reason or "").lower()
+    if "agent" in reason and "start" in reason:
+        return "starting"
+    if "limit" in reason or "maximum" in reason:
+        return "limit"
+    if "agent" in reason:
+        return "agents"
+    return "other"
+
+
+def pods_fitting(available, needed):
+    """
+    How many pods needing `needed` fit into `available` (both keyed by resource name),
+    None when no resource is constrained.
+    """
+    counts = [math.floor(available[r] / amount) for r, amount in needed.items() if r in available and amount > 0]
+    return max(0, min(counts)) if counts else None
+
+
+def quota_capacity(quotas, needed):
+    """
+    Agent pods the namespace ResourceQuotas allow at once, assuming the namespace is
+    dedicated to agents; None without a quota on any resource the pod needs.
+    """
+    caps = []
+    for quota in quotas:
+        hard = {r: kubeapi.parse_quantity(v) for r, v in quota.get("status", {}).get("hard", {}).items()}
+        fitting = pods_fitting(hard, needed)
+        if fitting is not None:
+            caps.append(fitting)
+    return min(caps) if caps else None
+
+
+def tolerates(tolerations, taint):
+    for toleration in tolerations or []:
+        if toleration.get("effect") and toleration["effect"] != taint.get("effect"):
+            continue
+        if toleration.get("operator") == "Exists":
+            if not toleration.get("key") or toleration["key"] == taint.get("key"):
+                return True
+        elif toleration.get("key") == taint.get("key") and toleration.get("value", "") == taint.get("value", ""):
+            return True
+    return False
+
+
+def eligible_nodes(nodes, pod_spec):
+    """
+    Ready, schedulable nodes matching the pod spec's nodeSelector and tolerating its
+    NoSchedule/NoExecute taints. Node affinity is not evaluated.
+    """
+    selector = pod_spec.get("nodeSelector") or {}
+    for node in nodes:
+        labels = node["metadata"].get("labels", {})
+        if any(labels.get(k) != v for k, v in selector.items()) or node.get("spec", {}).get("unschedulable"):
+            continue
+        if any(t.get("effect") in ("NoSchedule", "NoExecute") and not tolerates(pod_spec.get("tolerations"), t)
+               for t in node.get("spec", {}).get("taints", [])):
+            continue
+        conditions = node.get("status", {}).get("conditions", [])
+        if not any(c.get("type") == "Ready" and c.get("status") == "True" for c in conditions):
+            continue
+        yield node
+
+
+def node_capacity(nodes, pod_spec, needed):
+    """
+    Agent pods the eligible nodes' allocatable resources hold at once, ignoring other
+    workloads; None when no node is eligible or nothing is constrained.
+    """
+    requests = {r: amount for r, amount in needed.items() if "." not in r and "/" not in r}
+    total = None
+    for node in eligible_nodes(nodes, pod_spec):
+        allocatable = {r: kubeapi.parse_quantity(v) for r, v in node.get("status", {}).get("allocatable", {}).items()}
+        fitting = pods_fitting(allocatable, requests)
+        if fitting is not None:
+            total = (total or 0) + fitting
+    return total
+
+
+def share(capacity, demand, demands):
+    """
+    A project's share of a capacity used by several projects, in proportion to demand.
+    """
+    if capacity is None:
+        return None
+    total = sum(demands)
+    if total <= 0:
+        return max(1, capacity // max(1, len(demands)))
+    return max(1, math.floor(capacity * demand / total))
+
+
+def demand(samples, pct=90, headroom=1):
+    """
+    Builds a project wanted to run at once: the `pct` percentile over the samples of
+    running builds plus builds held back by a limit, rounded up, plus `headroom`.
+    """
+    wanted = [s["running"] + s["starting"] + s["limit"] for s in samples]
+    return math.ceil(stats.percentile(wanted, pct)) + headroom
+
+
+def recommend(current, wanted, caps, min_limit, max_limit):
+    """
+    Return (buildsLimit, reason) for one executor. `caps` maps a capacity name
+    ("quota", "nodes") to the project's share of it, None when unknown.
+    """
+    limit, reason = wanted, f"demand {wanted}"
+    for name, cap in sorted(caps.items()):
+        if cap is not None and cap < limit:
+            limit, reason = cap, f"{name} capacity {cap} (demand {wanted})"
+    if limit < min_limit:
+        limit, reason = min_limit, f"{reason}, raised to minimum {min_limit}"
+    elif limit > max_limit:
+        limit, reason = max_limit, f"{reason}, capped at maximum {max_limit}"
+    if limit == current:
+        reason = f"{reason}, unchanged"
+    return limit, reason
@@ -34,3 +34,18 @@ helm.sh/chart: {{ printf "%s-%s" .Chart.Name .Chart.Version | replace "+" "_" |
 {{ .Values.teamcity.existingApiTokenSecret }}
 {{- end }}
 {{- end }}
+
+{{- define "teamcity-k8s-agent.cacheVolume" -}}
+- name: cache-volume
+{{- if .Values.cache.existingClaim }}
+  persistentVolumeClaim:
+    claimName: {{ .Values.cache.existingClaim | quote }}
+{{- else }}
+  emptyDir: {}
+{{- end }}
+{{- end }}
+
+{{- /* Marks the TeamCity connectors this release creates, so that prune leaves other releases' alone */}}
+{{- define "teamcity-k8s-agent.owner" -}}
+{{ .Release.Namespace }}/{{ .Release.Name }}
+{{- end }}
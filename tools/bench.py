@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the chart scripts against the stub TeamCity server at scale.
+
+Starts tools/fake_teamcity.py in-process, writes a manifest of `--projects` projects
+and runs the registration flow (add-project.py, twice: first install then a
+steady-state upgrade) and the smoke-test flow (smoketest.py) against it. For each
+flow it reports the wall time, REST calls per project and bytes transferred, broken
+down per endpoint with --verbose.
+
+    python tools/bench.py --projects 500 --latency 0.02
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_teamcity  # noqa: E402
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "charts", "teamcity-k8s-agent", "files")
+
+
+def write_manifest(path, count, with_smoke_test):
+    projects = []
+    for i in range(count):
+        project = {
+            "name": f"Bench Project {i:04d}",
+            "k8sProfile": {
+                "name": f"K8s Profile {i:04d}",
+                "apiServerUrl": "https://kubernetes.default.svc",
+                "namespace": f"bench-{i:04d}",
+                "templateName": "default",
+                "buildsLimit": 2,
+                "containerParameters": {"cpu": "500m", "memory": "1Gi"},
+            },
+        }
+        if with_smoke_test:
+            project["smokeTest"] = {"gitUrl": "https://example.com/bench.git"}
+        projects.append(project)
+    with open(path, 'w') as f:
+        json.dump(projects, f)
+
+
+def run_flow(teamcity, name, command, projects, log=print):
+    teamcity.reset_stats()
+    env = dict(os.environ, API_TOKEN="bench", TEAMCITY_TOKEN="bench", PYTHONDONTWRITEBYTECODE="1")
+    start = time.monotonic()
+    proc = subprocess.run([sys.executable] + command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.monotonic() - start
+    stats = teamcity.reset_stats()
+    if proc.returncode != 0:
+        log(proc.stdout[-4000:])
+        log(f"{name}: exit code {proc.returncode}")
+
+    calls = sum(s["calls"] for s in stats.values())
+    return {
+        "flow": name,
+        "exit_code": proc.returncode,
+        "seconds": round(elapsed, 2),
+        "calls": calls,
+        "calls_per_project": round(calls / projects, 2),
+        "errors": sum(s["errors"] for s in stats.values()),
+        "bytes_in": sum(s["bytes_in"] for s in stats.values()),
+        "bytes_out": sum(s["bytes_out"] for s in stats.values()),
+        "endpoints": stats,
+    }
+
+
+def print_results(results, verbose=False):
+    print(f"{'flow':<24} {'seconds':>8} {'calls':>7} {'calls/proj':>10} {'errors':>6} {'KiB sent':>9} {'KiB recv':>9}")
+    for r in results:
+        print(f"{r['flow']:<24} {r['seconds']:>8} {r['calls']:>7} {r['calls_per_project']:>10} {r['errors']:>6} "
+              f"{r['bytes_in'] / 1024:>9.1f} {r['bytes_out'] / 1024:>9.1f}")
+        if verbose:
+            for endpoint, s in sorted(r["endpoints"].items(), key=lambda e: -e[1]["calls"]):
+                print(f"    {endpoint:<70} {s['calls']:>7} {s['bytes_out'] / 1024:>9.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark add-project.py and smoketest.py against a stub TeamCity")
+    parser.add_argument("--projects", type=int, default=500, help="Number of projects in the manifest")
+    parser.add_argument("--existing-projects", type=int, default=0, help="Unrelated projects already on the server")
+    parser.add_argument("--smoke-projects", type=int, default=None, help="Projects smoke tested (default: --projects)")
+    parser.add_argument("--concurrency", type=int, default=8, help="--concurrency passed to the scripts")
+    parser.add_argument("--rate-limit", type=float, default=0, help="--rate-limit passed to the scripts")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failed with a 503")
+    parser.add_argument("--agents", type=int, default=50, help="Builds that can run at once")
+    parser.add_argument("--agent-startup", type=float, default=0.2, help="Seconds for an agent pod to start")
+    parser.add_argument("--build-duration", type=float, default=0.2, help="Seconds each build runs")
+    parser.add_argument("--skip-smoke-test", action="store_true", help="Only benchmark the registration flow")
+    parser.add_argument("--cache", action="store_true", help="Run the scripts with an id cache file")
+    parser.add_argument("--json", default=None, help="Write the results as JSON to this file ('-' for stdout)")
+    parser.add_argument("--verbose", action="store_true", help="Show calls and bytes per endpoint")
+    args = parser.parse_args()
+
+    teamcity = fake_teamcity.FakeTeamCity(args.agents, 0.0, args.agent_startup, args.build_duration,
+                                          args.latency, args.error_rate)
+    for i in range(args.existing_projects):
+        teamcity.seed_project(f"Existing Project {i:05d}")
+    server = fake_teamcity.make_server(teamcity, "127.0.0.1")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        token, cacert = os.path.join(tmp, "token"), os.path.join(tmp, "ca.crt")
+        for path in (token, cacert):
+            with open(path, 'w') as f:
+                f.write("bench\n")
+        manifest = os.path.join(tmp, "projects.json")
+        write_manifest(manifest, args.projects, with_smoke_test=False)
+        common = ["--teamcity-url", url, "--concurrency", str(args.concurrency), "--rate-limit", str(args.rate_limit)]
+
+        register = [os.path.join(FILES, "add-project.py"), "--manifest", manifest,
+                    "--token-path", token, "--cacert-path", cacert, "--skip-preflight"] + common
+        if args.cache:
+            register += ["--cache-file", os.path.join(tmp, "register-cache.json")]
+        results.append(run_flow(teamcity, "register (install)", register, args.projects))
+        results.append(run_flow(teamcity, "register (steady)", register, args.projects))
+
+        if not args.skip_smoke_test:
+            smoke_count = args.smoke_projects or args.projects
+            smoke_manifest = os.path.join(tmp, "smoke.json")
+            write_manifest(smoke_manifest, smoke_count, with_smoke_test=True)
+            smoke = [os.path.join(FILES, "smoketest.py"), "--manifest", smoke_manifest, "--timeout", "120",
+                     "--poll-interval", "0.1", "--max-poll-interval", "1"] + common
+            if args.cache:
+                smoke += ["--cache-file", os.path.join(tmp, "smoke-cache.json")]
+            results.append(run_flow(teamcity, "smoke test", smoke, smoke_count))
+    server.shutdown()
+
+    print_results(results, args.verbose)
+    if args.json:
+        data = json.dumps(results, indent=2)
+        if args.json == "-":
+            print(data)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(data)
+    sys.exit(1 if any(r["exit_code"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+
+"""
+Stub TeamCity REST server for exercising the teamcity-k8s-agent chart scripts
+without a TeamCity server or a Kubernetes cluster.
+
+It implements the endpoints add-project.py and smoketest.py use (projects and their
+projectFeatures, vcs-roots, buildTypes with their steps and vcs-root-entries,
+buildQueue, builds and agents), honours the locators and `fields=` projections they send, and
+simulates the life of a build on a Kubernetes executor: it waits for one of
+`--agents` slots, waits for the agent pod to start (`--agent-startup`), then runs
+(`--build-duration`). Every request can be delayed (`--latency`) or failed at random
+(`--error-rate`), and calls and bytes are counted per endpoint (GET /__stats).
+
+    python tools/fake_teamcity.py --port 8111 --projects "Project A" --agents 4
+    TEAMCITY_TOKEN=x python charts/teamcity-k8s-agent/files/smoketest.py \
+        --teamcity-url http://127.0.0.1:8111 --project-name "Project A" --git-url x --benchmark 10
+"""
+
+import re
+import json
+import time
+import base64
+import random
+import argparse
+import itertools
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def parse_fields(fields):
+    """
+    Parse a `fields=` projection like "id,name,properties(property(name,value))" into
+    {"id": None, "name": None, "properties": {"property": {...}}}.
+    """
+    spec = {}
+    stack = [spec]
+    name = ""
+    for char in fields + ",":
+        if char in ",()":
+            if name:
+                stack[-1][name] = None
+            if char == "(":
+                stack[-1][name] = {}
+                stack.append(stack[-1][name])
+            elif char == ")":
+                stack.pop()
+            name = ""
+        else:
+            name += char
+    return spec
+
+
+def project_fields(value, spec):
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project_fields(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {key: project_fields(value[key], sub) for key, sub in spec.items() if key in value}
+    return value
+
+
+def split_locator(locator):
+    """
+    Split a TeamCity locator into {dimension: value}, keeping nested parentheses intact.
+    """
+    dimensions = {}
+    depth = 0
+    current = ""
+    for char in (locator or "") + ",":
+        if char == "," and depth == 0:
+            if current:
+                name, _, value = current.partition(":")
+                if value.startswith("(") and value.endswith(")"):
+                    value = value[1:-1]
+                if value.startswith("$base64:"):
+                    encoded = value[len("$base64:"):]
+                    value = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+                dimensions[name] = value
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        current += char
+    return dimensions
+
+
+class FakeTeamCity:
+    """
+    In-memory TeamCity state. `route` maps a request to a (status, JSON-able body) pair.
+    """
+    def __init__(self, agents=2, queue_delay=0.0, agent_startup=1.0, build_duration=1.0,
+                 latency=0.0, error_rate=0.0, error_status=503, retry_after=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.stats = {}
+        self.queue_delay = queue_delay
+        self.agent_startup = agent_startup
+        self.build_duration = build_duration
+        self.agent_free_at = [0.0] * max(1, agents)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.projects = {}
+        self.vcs_roots = {}
+        self.build_types = {}
+        self.builds = {}
+        self.features = {}
+        self.agents = {}
+        self.routes = [
+            ("GET", r"/app/rest/projects", self.list_projects),
+            ("POST", r"/app/rest/projects", self.create_project),
+            ("GET", r"/app/rest/projects/id:([^/]+)", self.get_project),
+            ("GET", r"/app/rest/projects/id:([^/]+)/projectFeatures", self.list_features),
+            ("POST", r"/app/rest/projects/id:([^/]+)/projectFeatures", self.create_feature),
+            ("GET", r"/app/rest/projects/id:([^/]+)/projectFeatures/id:([^/]+)", self.get_feature),
+            ("PUT", r"/app/rest/projects/id:([^/]+)/projectFeatures/id:([^/]+)", self.put_feature),
+            ("DELETE", r"/app/rest/projects/id:([^/]+)/projectFeatures/id:([^/]+)", self.delete_feature),
+            ("GET", r"/app/rest/vcs-roots", self.list_vcs_roots),
+            ("POST", r"/app/rest/vcs-roots", self.create_vcs_root),
+            ("GET", r"/app/rest/vcs-roots/id:([^/]+)", self.get_vcs_root),
+            ("PUT", r"/app/rest/vcs-roots/id:([^/]+)", self.put_vcs_root),
+            ("DELETE", r"/app/rest/vcs-roots/id:([^/]+)", self.delete_vcs_root),
+            ("GET", r"/app/rest/buildTypes", self.list_build_types),
+            ("POST", r"/app/rest/buildTypes", self.create_build_type),
+            ("GET", r"/app/rest/buildTypes/id:([^/]+)", self.get_build_type),
+            ("DELETE", r"/app/rest/buildTypes/id:([^/]+)", self.delete_build_type),
+            ("GET", r"/app/rest/buildTypes/id:([^/]+)/steps", self.list_steps),
+            ("POST", r"/app/rest/buildTypes/id:([^/]+)/steps", self.create_step),
+            ("PUT", r"/app/rest/buildTypes/id:([^/]+)/steps/([^/]+)", self.put_step),
+            ("GET", r"/app/rest/buildTypes/id:([^/]+)/vcs-root-entries", self.list_vcs_root_entries),
+            ("POST", r"/app/rest/buildTypes/id:([^/]+)/vcs-root-entries", self.create_vcs_root_entry),
+            ("DELETE", r"/app/rest/buildTypes/id:([^/]+)/vcs-root-entries/id:([^/]+)", self.delete_vcs_root_entry),
+            ("GET", r"/app/rest/buildQueue", self.list_queue),
+            ("POST", r"/app/rest/buildQueue", self.queue_build),
+            ("GET", r"/app/rest/builds", self.list_builds),
+            ("GET", r"/app/rest/builds/id:(\d+)", self.get_build),
+            ("DELETE", r"/app/rest/builds/id:(\d+)", self.delete_build),
+            ("GET", r"/app/rest/agents/id:(\d+)", self.get_agent),
+        ]
+
+    def new_id(self, prefix):
+        return f"{prefix}{next(self.ids)}"
+
+    def seed_project(self, name):
+        project_id = re.sub(r"\W", "", name) or self.new_id("Project")
+        if project_id in self.projects:
+            project_id = self.new_id(project_id)
+        self.projects[project_id] = {"id": project_id, "name": name, "parentProjectId": "_Root"}
+        self.features[project_id] = {}
+        return project_id
+
+    def route(self, method, path, query, body):
+        """
+        Return (status, body, endpoint) where endpoint is the matched route template.
+        """
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                endpoint = re.sub(r"\(.*?\)", "{id}", pattern)
+                with self.lock:
+                    status, result = handler(*match.groups(), query=query, body=body)
+                return status, result, endpoint
+        return 404, {"message": f"No such endpoint: {method} {path}"}, path
+
+    def handle(self, method, path, query, raw):
+        """
+        Serve one request with injected latency and errors, apply the `fields`
+        projection and count it. Returns (status, response bytes, extra headers).
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        headers = {}
+        if self.error_rate and random.random() < self.error_rate:
+            status, result, endpoint = self.error_status, {"message": "Injected error"}, path
+            if self.retry_after is not None:
+                headers["Retry-After"] = str(self.retry_after)
+        else:
+            status, result, endpoint = self.route(method, path, query, json.loads(raw) if raw else None)
+            if status == 200 and "fields" in query:
+                result = project_fields(result, parse_fields(query["fields"]))
+        data = json.dumps(result).encode() if result is not None else b""
+
+        with self.lock:
+            stat = self.stats.setdefault(f"{method} {endpoint}", {"calls": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0})
+            stat["calls"] += 1
+            stat["errors"] += status >= 400
+            stat["bytes_in"] += len(raw)
+            stat["bytes_out"] += len(data)
+        return status, data, headers
+
+    def reset_stats(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    @staticmethod
+    def filter_items(items, query, matchers):
+        """
+        Apply the locator dimensions we understand and start/count paging.
+        """
+        locator = split_locator(query.get("locator"))
+        for dimension, matcher in matchers.items():
+            if dimension in locator:
+                items = [item for item in items if matcher(item, locator[dimension])]
+        start = int(locator.get("start", 0))
+        count = int(locator["count"]) if "count" in locator else None
+        return items[start:start + count if count is not None else None]
+
+    # Projects
+
+    def list_projects(self, query, body):
+        items = self.filter_items(list(self.projects.values()), query, {
+            "name": lambda p, v: p["name"] == v,
+            "id": lambda p, v: p["id"] == v,
+        })
+        return 200, {"count": len(items), "project": [
+            dict(p, projectFeatures={"projectFeature": list(self.features[p["id"]].values())}) for p in items]}
+
+    def create_project(self, query, body):
+        if any(p["name"] == body["name"] for p in self.projects.values()):
+            return 400, {"message": f"Project with name '{body['name']}' already exists"}
+        project_id = self.seed_project(body["name"])
+        parent = split_locator(body.get("parentProject", {}).get("locator")).get("id", "_Root")
+        self.projects[project_id]["parentProjectId"] = parent
+        return 200, self.projects[project_id]
+
+    def in_project(self, project_id, ancestor_id):
+        """
+        Whether `project_id` is `ancestor_id` or one of its subprojects.
+        """
+        while project_id in self.projects:
+            if project_id == ancestor_id:
+                return True
+            project_id = self.projects[project_id]["parentProjectId"]
+        return False
+
+    def get_project(self, project_id, query, body):
+        project = self.projects.get(project_id)
+        if not project:
+            return 404, {"message": f"No project found by locator 'id:{project_id}'"}
+        return 200, dict(project, projectFeatures={"projectFeature": list(self.features[project_id].values())})
+
+    # Project features (connectors and executors)
+
+    def list_features(self, project_id, query, body):
+        if project_id not in self.projects:
+            return 404, {"message": "Project not found"}
+        items = self.filter_items(list(self.features[project_id].values()), query, {
+            "type": lambda f, v: f["type"] == v,
+        })
+        return 200, {"count": len(items), "projectFeature": items}
+
+    def create_feature(self, project_id, query, body):
+        if project_id not in self.projects:
+            return 404, {"message": "Project not found"}
+        feature = {"id": self.new_id("PROJECT_EXT_"), "type": body["type"], "properties": body.get("properties", {})}
+        self.features[project_id][feature["id"]] = feature
+        return 200, feature
+
+    def get_feature(self, project_id, feature_id, query, body):
+        feature = self.features.get(project_id, {}).get(feature_id)
+        return (200, feature) if feature else (404, {"message": "Feature not found"})
+
+    def put_feature(self, project_id, feature_id, query, body):
+        if feature_id not in self.features.get(project_id, {}):
+            return 404, {"message": "Feature not found"}
+        feature = {"id": feature_id, "type": body["type"], "properties": body.get("properties", {})}
+        self.features[project_id][feature_id] = feature
+        return 200, feature
+
+    def delete_feature(self, project_id, feature_id, query, body):
+        if self.features.get(project_id, {}).pop(feature_id, None) is None:
+            return 404, {"message": "Feature not found"}
+        return 204, None
+
+    # VCS roots
+
+    def list_vcs_roots(self, query, body):
+        items = self.filter_items(list(self.vcs_roots.values()), query, {
+            "name": lambda v, value: v["name"] == value,
+            "project": lambda v, value: v["project"]["id"] == split_locator(value).get("id"),
+        })
+        return 200, {"count": len(items), "vcs-root": items}
+
+    def create_vcs_root(self, query, body):
+        if body["project"]["id"] not in self.projects:
+            return 404, {"message": "Project not found"}
+        vcs_root = dict(body, id=self.new_id("VcsRoot"))
+        self.vcs_roots[vcs_root["id"]] = vcs_root
+        return 200, vcs_root
+
+    def get_vcs_root(self, vcs_root_id, query, body):
+        vcs_root = self.vcs_roots.get(vcs_root_id)
+        return (200, vcs_root) if vcs_root else (404, {"message": "VCS root not found"})
+
+    def put_vcs_root(self, vcs_root_id, query, body):
+        if vcs_root_id not in self.vcs_roots:
+            return 404, {"message": "VCS root not found"}
+        self.vcs_roots[vcs_root_id] = dict(body, id=vcs_root_id)
+        return 200, self.vcs_roots[vcs_root_id]
+
+    def delete_vcs_root(self, vcs_root_id, query, body):
+        if any(e["id"] == vcs_root_id for bt in self.build_types.values() for e in bt["vcs-root-entries"]):
+            return 400, {"message": "VCS root is used by build configurations"}
+        if self.vcs_roots.pop(vcs_root_id, None) is None:
+            return 404, {"message": "VCS root not found"}
+        return 204, None
+
+    # Build configurations
+
+    def list_build_types(self, query, body):
+        items = self.filter_items(list(self.build_types.values()), query, {
+            "name": lambda bt, v: bt["name"] == v,
+            "project": lambda bt, v: bt["projectId"] == split_locator(v).get("id"),
+        })
+        return 200, {"count": len(items), "buildType": [
+            dict({k: v for k, v in bt.items() if k not in ("steps", "vcs-root-entries")},
+                 **{"vcs-root-entries": {"vcs-root-entry": bt["vcs-root-entries"]}}) for bt in items]}
+
+    def create_build_type(self, query, body):
+        if body["project"]["id"] not in self.projects:
+            return 404, {"message": "Project not found"}
+        build_type_id = self.new_id("BuildType")
+        self.build_types[build_type_id] = {
+            "id": build_type_id, "name": body["name"], "projectId": body["project"]["id"],
+            "steps": [], "vcs-root-entries": [],
+        }
+        return 200, {"id": build_type_id, "name": body["name"], "projectId": body["project"]["id"]}
+
+    def get_build_type(self, build_type_id, query, body):
+        build_type = self.build_types.get(build_type_id)
+        if not build_type:
+            return 404, {"message": "Build configuration not found"}
+        return 200, dict(build_type, steps={"step": build_type["steps"]})
+
+    def delete_build_type(self, build_type_id, query, body):
+        if self.build_types.pop(build_type_id, None) is None:
+            return 404, {"message": "Build configuration not found"}
+        for build_id in [b["id"] for b in self.builds.values() if b["buildTypeId"] == build_type_id]:
+            del self.builds[build_id]
+        return 204, None
+
+    def list_steps(self, build_type_id, query, body):
+        build_type = self.build_types.get(build_type_id)
+        return (200, {"step": build_type["steps"]}) if build_type else (404, {"message": "Build configuration not found"})
+
+    def create_step(self, build_type_id, query, body):
+        step = dict(body, id=self.new_id("RUNNER_"))
+        self.build_types[build_type_id]["steps"].append(step)
+        return 200, step
+
+    def put_step(self, build_type_id, step_id, query, body):
+        steps = self.build_types[build_type_id]["steps"]
+        for i, step in enumerate(steps):
+            if step["id"] == step_id:
+                steps[i] = dict(body, id=step_id)
+                return 200, steps[i]
+        return 404, {"message": "Step not found"}
+
+    def list_vcs_root_entries(self, build_type_id, query, body):
+        build_type = self.build_types.get(build_type_id)
+        if not build_type:
+            return 404, {"message": "Build configuration not found"}
+        return 200, {"vcs-root-entry": build_type["vcs-root-entries"]}
+
+    def create_vcs_root_entry(self, build_type_id, query, body):
+        entry = {"id": body["vcs-root"]["id"], "vcs-root": {"id": body["vcs-root"]["id"]}}
+        self.build_types[build_type_id]["vcs-root-entries"].append(entry)
+        return 200, entry
+
+    def delete_vcs_root_entry(self, build_type_id, vcs_root_id, query, body):
+        build_type = self.build_types.get(build_type_id)
+        entries = build_type["vcs-root-entries"] if build_type else []
+        if not any(e["id"] == vcs_root_id for e in entries):
+            return 404, {"message": "VCS root entry not found"}
+        build_type["vcs-root-entries"] = [e for e in entries if e["id"] != vcs_root_id]
+        return 204, None
+
+    # Builds
+
+    def queue_build(self, query, body):
+        build_type_id = body["buildType"]["id"]
+        if build_type_id not in self.build_types:
+            return 404, {"message": "Build configuration not found"}
+        now = time.monotonic()
+        slot = min(range(len(self.agent_free_at)), key=self.agent_free_at.__getitem__)
+        starting = max(now, self.agent_free_at[slot]) + self.queue_delay
+        started = starting + self.agent_startup
+        finished = started + self.build_duration
+        self.agent_free_at[slot] = finished
+        build_id = next(self.ids)
+        # Every build gets a fresh agent pod, which registers shortly before the build starts
+        agent_id = next(self.ids)
+        registered = time.time() + (starting - now) + self.agent_startup * 0.8
+        self.agents[agent_id] = {
+            "id": agent_id, "name": f"agent-{slot + 1}-{agent_id}",
+            "registrationTimestamp": time.strftime("%Y%m%dT%H%M%S+0000", time.gmtime(registered)),
+        }
+        self.builds[build_id] = {
+            "id": build_id, "buildTypeId": build_type_id, "agent": agent_id,
+            "starting": starting, "started": started, "finished": finished,
+        }
+        return 200, {"id": build_id, "buildTypeId": build_type_id, "state": "queued"}
+
+    def get_build(self, build_id, query, body):
+        build = self.builds.get(int(build_id))
+        if not build:
+            return 404, {"message": "Build not found"}
+        return 200, self.build_state(build, time.monotonic())
+
+    def list_queue(self, query, body):
+        now = time.monotonic()
+        builds = [self.build_state(b, now) for b in self.builds.values()]
+        items = self.filter_items([b for b in builds if b["state"] == "queued"], query, {
+            "affectedProject": lambda b, v: self.in_project(b["buildType"]["projectId"], split_locator(v).get("id")),
+        })
+        return 200, {"count": len(items), "build": items}
+
+    def list_builds(self, query, body):
+        now = time.monotonic()
+        # Newest first, like TeamCity
+        builds = [self.build_state(b, now) for b in sorted(self.builds.values(), key=lambda b: -b["id"])]
+        items = self.filter_items(builds, query, {
+            "state": lambda b, v: b["state"] == v,
+            "buildType": lambda b, v: b["buildTypeId"] == split_locator(v).get("id"),
+            "affectedProject": lambda b, v: self.in_project(b["buildType"]["projectId"], split_locator(v).get("id")),
+        })
+        return 200, {"count": len(items), "build": items}
+
+    def delete_build(self, build_id, query, body):
+        if self.builds.pop(int(build_id), None) is None:
+            return 404, {"message": "Build not found"}
+        return 204, None
+
+    def get_agent(self, agent_id, query, body):
+        agent = self.agents.get(int(agent_id))
+        if not agent:
+            return 404, {"message": "Agent not found"}
+        return 200, dict(agent)
+
+    def build_state(self, build, now):
+        build_type = {"id": build["buildTypeId"], "projectId": self.build_types[build["buildTypeId"]]["projectId"]}
+        result = {"id": build["id"], "buildTypeId": build["buildTypeId"], "buildType": build_type}
+        if now < build["starting"]:
+            result.update(state="queued", waitReason="Waiting for a compatible agent")
+        elif now < build["started"]:
+            result.update(state="queued", waitReason="Waiting for the starting agent")
+        else:
+            if now >= build["finished"]:
+                finished = time.time() - (now - build["finished"])
+                result["finishDate"] = time.strftime("%Y%m%dT%H%M%S+0000", time.gmtime(finished))
+            result.update(state="running" if now < build["finished"] else "finished",
+                          status="SUCCESS", agent={"id": build["agent"], "name": self.agents[build["agent"]]["name"]})
+        return result
+
+
+class FakeTeamCityHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; don't let Nagle delay keep-alive responses
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        parts = urllib.parse.urlsplit(self.path)
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(parts.query).items()}
+        teamcity = self.server.teamcity
+        if parts.path == "/__stats":
+            status, data, headers = 200, json.dumps(teamcity.stats).encode(), {}
+            if self.command == "DELETE":
+                teamcity.reset_stats()
+        else:
+            status, data, headers = teamcity.handle(self.command, parts.path, query, raw)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+def make_server(teamcity, host="127.0.0.1", port=0):
+    """
+    Create (but don't start) an HTTP server for `teamcity`; port 0 picks a free port.
+    """
+    server = ThreadingHTTPServer((host, port), FakeTeamCityHandler)
+    server.daemon_threads = True
+    server.teamcity = teamcity
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub TeamCity REST server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8111)
+    parser.add_argument("--projects", default="", help="Comma-separated project names to create at startup")
+    parser.add_argument("--agents", type=int, default=2, help="Number of builds that can run at once")
+    parser.add_argument("--queue-delay", type=float, default=0.0, help="Seconds before an agent pod is requested")
+    parser.add_argument("--agent-startup", type=float, default=1.0, help="Seconds for an agent pod to start and connect")
+    parser.add_argument("--build-duration", type=float, default=1.0, help="Seconds each build runs")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failed with --error-status")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument("--retry-after", type=int, default=None, help="Retry-After seconds sent with injected errors")
+    args = parser.parse_args()
+
+    teamcity = FakeTeamCity(args.agents, args.queue_delay, args.agent_startup, args.build_duration,
+                            args.latency, args.error_rate, args.error_status, args.retry_after)
+    for name in filter(None, (n.strip() for n in args.projects.split(","))):
+        teamcity.seed_project(name)
+    server = make_server(teamcity, args.host, args.port)
+    print(f"Fake TeamCity listening on http://{args.host}:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()